@@ -0,0 +1,67 @@
+"""Concurrent /search load against the micro-batching encoder.
+
+Usage: python bench_encoder.py [--requests 2000] [--concurrency 1,8,32,64]
+                               [--max-batch 32] [--max-wait-ms 5]
+
+Drives the app in-process (httpx ASGI transport, no network) with the
+given numbers of concurrent clients and prints requests/s, client
+latency and the encoder's batch size, queue wait and throughput for each.
+Set --max-batch 1 to compare with one model call per query. The result
+cache is disabled, so every request reaches the encoder. Without
+sentence-transformers the mock embeddings are timed, so batching shows in
+the batch sizes rather than in the throughput.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", default="1,8,32,64")
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    return parser.parse_args()
+
+async def run(app, requests, concurrency):
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client_loop(client):
+        for i in remaining:
+            start = time.perf_counter()
+            r = await client.post("/search", json={"query": f"payment terms for invoice {i % 500}", "k": 5})
+            r.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+        return requests / (time.perf_counter() - start), np.array(latencies)
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.environ["ENCODE_MAX_BATCH"] = str(args.max_batch)
+    os.environ["ENCODE_MAX_WAIT_MS"] = str(args.max_wait_ms)
+    # Repeated queries would otherwise be cache hits that never get encoded
+    os.environ["RESULT_CACHE_SIZE"] = "0"
+    import main  # reads the settings above
+
+    print(f"max batch {args.max_batch}, max wait {args.max_wait_ms} ms, {args.requests} requests")
+    print(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'batch':>6} {'wait p50':>9} "
+          f"{'wait p99':>9} {'texts/s':>8}")
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        encoder = main.query_encoder
+        with encoder.lock:
+            encoder.recent.clear()
+            encoder.waits.clear()
+        rate, lat = asyncio.run(run(main.app, args.requests, concurrency))
+        stats = encoder.stats()
+        print(f"{concurrency:7} {rate:8.1f} {np.percentile(lat, 50):8.2f} {np.percentile(lat, 99):8.2f} "
+              f"{stats['avgBatchSize']:6.2f} {stats['queueWaitMs']['p50']:9.3f} "
+              f"{stats['queueWaitMs']['p99']:9.3f} {stats['throughput']:8.1f}")
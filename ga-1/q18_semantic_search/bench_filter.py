@@ -0,0 +1,42 @@
+"""Filtered search: gather the selected rows vs scan everything and mask.
+
+Usage: python bench_filter.py [--docs 1000000] [--dim 384]
+
+Times both strategies retrieve() chooses between, in ms per query, for a
+range of filter selectivities. FILTER_GATHER_MAX should sit a little
+below the crossover.
+"""
+import argparse
+
+import numpy as np
+
+from bench_topk import timed, unit_rows
+from filters import FILTER_GATHER_MAX
+from index import top_k
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    docs = unit_rows(rng, args.docs, args.dim)
+    q = unit_rows(rng, 1, args.dim)[0]
+    print(f"{args.docs} docs, dim {args.dim}; FILTER_GATHER_MAX {FILTER_GATHER_MAX}")
+    print(f"{'selected':>8} {'gather':>9} {'scan+mask':>10}")
+    for fraction in (0.001, 0.01, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5):
+        allowed = rng.random(args.docs) < fraction
+        selected = np.flatnonzero(allowed)
+
+        def gather():
+            return selected[top_k(np.dot(np.take(docs, selected, axis=0), q), args.k)]
+
+        def scan():
+            scores = np.dot(docs, q)
+            scores[~allowed] = -np.inf
+            return top_k(scores, args.k)
+
+        assert set(gather()) == set(scan())
+        print(f"{fraction:8.3f} {timed(gather, 3) * 1000:9.2f} {timed(scan, 3) * 1000:10.2f}")
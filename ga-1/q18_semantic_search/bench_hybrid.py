@@ -0,0 +1,74 @@
+"""Cost of hybrid (BM25 + vector) retrieval per query.
+
+Usage: python bench_hybrid.py [--docs 1000000] [--dim 384]
+
+Builds a BM25 index over synthetic documents (Zipf-distributed words) and
+random unit embeddings, then times, in ms per query: the BM25 top list,
+the vector scan plus top list, each fusion step on its own, and both
+retrievers run one after the other vs concurrently as retrieve() does.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from bench_topk import timed, unit_rows
+from bm25 import BM25Index, FUSION_DEPTH, fuse, search_later
+from index import top_k
+
+def make_texts(rng, n, words, length=20, vocab=50000):
+    ids = (rng.zipf(1.2, (n, length)) - 1) % vocab
+    return [" ".join(words[i] for i in row) for row in ids]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(50000)]
+    start = time.perf_counter()
+    lexical = BM25Index(make_texts(rng, args.docs, words))
+    print(f"BM25 index: {args.docs} docs, {len(lexical.vocab)} terms, "
+          f"{len(lexical.doc_ids)} postings, {lexical.doc_ids.nbytes + lexical.tfs.nbytes >> 20} MiB, "
+          f"built in {time.perf_counter() - start:.1f}s")
+    docs = unit_rows(rng, args.docs, args.dim)
+    # Queries mix a frequent word with rarer ones, like real keyword queries
+    queries = [" ".join(words[i] for i in (rng.zipf(1.5, 4) - 1) % 2000) for _ in range(args.queries)]
+    q = unit_rows(rng, 1, args.dim)[0]
+    depth = max(args.k, FUSION_DEPTH)
+
+    def lexical_top():
+        return [lexical.search(query, depth) for query in queries]
+
+    def vector_top():
+        scores = np.dot(docs, q)
+        return scores, top_k(scores, depth)
+
+    scores, vec_rows = vector_top()
+    lex = lexical_top()
+    n = len(queries)
+    rows = {
+        "bm25 top list": timed(lexical_top, 3) / n,
+        "vector scan + top list": timed(vector_top, 3),
+    }
+    for mode in ("rrf", "weighted"):
+        rows[f"fusion only ({mode})"] = timed(
+            lambda: [fuse(mode, vec_rows, lx[0], args.k, scores.__getitem__, lexical, query)
+                     for query, lx in zip(queries, lex)], 3) / n
+
+    def concurrent():
+        # One vector scan per query, overlapped with that query's BM25 search
+        for query in queries:
+            later = search_later(lexical, [query], depth)
+            scores, top = vector_top()
+            fuse("rrf", top, later.result()[0][0], args.k, scores.__getitem__, lexical, query)
+
+    rows["hybrid, sequential"] = sum(rows[name] for name in
+                                     ("bm25 top list", "vector scan + top list", "fusion only (rrf)"))
+    rows["hybrid, concurrent"] = timed(concurrent, 1) / n
+    for name, seconds in rows.items():
+        print(f"{name:24} {seconds * 1000:9.3f} ms")
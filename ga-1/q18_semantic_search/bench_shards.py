@@ -0,0 +1,76 @@
+"""Sharded search scaling from 1 to N worker processes.
+
+Usage: python bench_shards.py [--docs 2000000] [--dim 384] [--processes 1,2,4,8]
+                              [--path /tmp/bench_shards.npy]
+
+Writes random unit embeddings to an .npy file once (reused on later runs
+with the same size), then for each process count splits the rows into
+one shard per worker, as ShardPool does, and times single-query latency
+and the throughput of a stream of queries with every worker busy. The
+file is memory-mapped, so the corpus may exceed RAM, but then the scan
+is bound by disk rather than cores. On a machine with fewer cores than
+workers the extra processes only add overhead.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bench_topk import unit_rows
+from shards import merge, search_shard
+
+def write_corpus(path, n, dim, chunk=100000):
+    if os.path.exists(path):
+        existing = np.load(path, mmap_mode="r")
+        if existing.shape == (n, dim):
+            return
+    rng = np.random.default_rng(0)
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n, dim))
+    for start in range(0, n, chunk):
+        out[start:start + chunk] = unit_rows(rng, min(chunk, n - start), dim)
+    out.flush()
+
+def shard_tasks(path, n, shards):
+    bounds = np.linspace(0, n, shards + 1).astype(np.int64)
+    return [[(path, int(lo), int(hi), 0, None)] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+def search(pool, tasks, q, k):
+    results = [f.result() for f in [pool.submit(search_shard, t, q, k) for t in tasks]]
+    return merge(np.concatenate([r for r, _ in results], axis=1),
+                 np.concatenate([s for _, s in results], axis=1), k)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=2000000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--processes", default="1,2,4,8")
+    parser.add_argument("--queries", type=int, default=16)
+    parser.add_argument("--path", default=os.path.join("/tmp", "bench_shards.npy"))
+    args = parser.parse_args()
+
+    write_corpus(args.path, args.docs, args.dim)
+    queries = unit_rows(np.random.default_rng(1), args.queries, args.dim)
+    print(f"{args.docs} docs x {args.dim} ({args.docs * args.dim * 4 >> 20} MiB), "
+          f"{os.cpu_count()} cores, k {args.k}")
+    print(f"{'procs':>5} {'latency ms':>11} {'speedup':>8} {'queries/s':>10} {'speedup':>8}")
+    base = None
+    for processes in (int(p) for p in args.processes.split(",")):
+        tasks = shard_tasks(args.path, args.docs, processes)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            search(pool, tasks, queries[:1], args.k)  # warm up: map and fault in
+            start = time.perf_counter()
+            for q in queries:
+                search(pool, tasks, q[None, :], args.k)
+            latency = (time.perf_counter() - start) / len(queries)
+
+            # Throughput: one shard task per query per worker, all in flight
+            start = time.perf_counter()
+            futures = [[pool.submit(search_shard, t, q[None, :], args.k) for t in tasks] for q in queries]
+            for per_query in futures:
+                [f.result() for f in per_query]
+            rate = len(queries) / (time.perf_counter() - start)
+        base = base or (latency, rate)
+        print(f"{processes:5} {latency * 1000:11.1f} {base[0] / latency:8.2f} {rate:10.1f} {rate / base[1]:8.2f}")
@@ -0,0 +1,59 @@
+"""Per-query search cost, single vs batched, argsort vs argpartition.
+
+Usage: python bench_topk.py [--sizes 64,1000,10000,100000,1000000] [--batch 32]
+
+Scores random unit vectors (dim 384, like all-MiniLM-L6-v2) the way
+retrieve() does and times the scoring plus top-k step only; encoding is
+left out since it does not depend on the corpus size.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from index import top_k
+
+def unit_rows(rng, n, dim):
+    m = rng.standard_normal((n, dim), dtype=np.float32)
+    m /= np.linalg.norm(m, axis=1, keepdims=True)
+    return m
+
+def timed(fn, repeat):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="64,1000,10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=32)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = unit_rows(rng, args.batch, args.dim)
+    q = queries[0]
+    print(f"dim {args.dim}, k {args.k}, batch {args.batch}; ms per query")
+    print(f"{'docs':>9} {'argsort':>10} {'argpartition':>13} {'batched':>10}")
+    for n in (int(s) for s in args.sizes.split(",")):
+        docs = unit_rows(rng, n, args.dim)
+        repeat = max(3, min(1000, 2_000_000 // n))
+
+        def full_sort():
+            return np.argsort(np.dot(docs, q))[::-1][:args.k]
+
+        def partition():
+            return top_k(np.dot(docs, q), args.k)
+
+        def batched():
+            return top_k(np.dot(queries, docs.T), args.k)
+
+        assert set(full_sort()) == set(partition()) == set(batched()[0])
+        sort_ms = timed(full_sort, repeat) * 1000
+        part_ms = timed(partition, repeat) * 1000
+        batch_ms = timed(batched, max(1, repeat // args.batch)) * 1000 / args.batch
+        print(f"{n:9} {sort_ms:10.4f} {part_ms:13.4f} {batch_ms:10.4f}")
+        del docs
@@ -0,0 +1,192 @@
+"""In-memory BM25 over the document contents.
+
+Postings are stored CSR-style: term t's documents are
+doc_ids[indptr[t]:indptr[t + 1]], sorted, with their term frequencies in
+tfs alongside and each document's length in lengths. Only those raw
+counts are stored: idf and avglen come from a BM25Stats at query time,
+so segments of one snapshot are scored against the whole snapshot's
+statistics. A query computes idf * tf * (k1 + 1) / (tf + k1 * (1 - b +
+b * len / avglen)) over its terms' postings and sums them per document.
+
+index.build() writes the postings next to embeddings.npy (save()), and
+segments memory-map them (load()) rather than re-tokenizing the corpus
+on every start.
+"""
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from index import top_k
+
+# Clause numbers like 12.3 stay one token
+_TOKEN = re.compile(r"\d+(?:\.\d+)+|[a-z0-9]+")
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+class BM25Stats:
+    """Collection statistics for scoring a set of indexes together:
+    document count, average length and each term's document frequency,
+    summed over all of them, so scores from a small segment compare with
+    the base's. Rows deleted but not yet compacted away still count."""
+
+    def __init__(self, indexes, k1=1.2, b=0.75):
+        self.indexes = list(indexes)
+        self.k1, self.b = k1, b
+        self.n_docs = sum(index.n_docs for index in self.indexes)
+        self.avglen = sum(index.total_length for index in self.indexes) / max(self.n_docs, 1)
+        self._norms = {}
+
+    def idf(self, term):
+        df = sum(index.df(term) for index in self.indexes)
+        return math.log1p((self.n_docs - df + 0.5) / (df + 0.5))
+
+    def norm(self, index):
+        """k1 * (1 - b + b * len / avglen) of each of index's documents."""
+        norm = self._norms.get(index)
+        if norm is None:
+            norm = self.k1 * (1 - self.b + self.b * index.lengths / max(self.avglen, 1e-9))
+            norm = self._norms[index] = norm.astype(np.float32)
+        return norm
+
+class BM25Index:
+    ARRAYS = ("indptr", "doc_ids", "tfs", "lengths")  # saved as bm25_<name>.npy
+
+    def __init__(self, texts):
+        self.vocab = {}
+        terms, docs, tfs, lengths = array("i"), array("i"), array("f"), array("f")
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                terms.append(self.vocab.setdefault(term, len(self.vocab)))
+                docs.append(doc)
+                tfs.append(tf)
+            lengths.append(sum(counts.values()))
+        terms, docs = np.frombuffer(terms, np.int32), np.frombuffer(docs, np.int32)
+        self.lengths = np.frombuffer(lengths, np.float32)
+
+        # Group by term; the stable sort keeps each posting list in doc order
+        order = np.argsort(terms, kind="stable")
+        self.doc_ids = docs[order]
+        self.tfs = np.frombuffer(tfs, np.float32)[order]
+        sizes = np.bincount(terms, minlength=len(self.vocab))
+        self.indptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.indptr[1:])
+        self._init_stats()
+
+    def _init_stats(self):
+        self.n_docs = len(self.lengths)
+        self.total_length = float(self.lengths.sum(dtype=np.float64))
+        self.stats = BM25Stats([self])
+
+    def save(self, path):
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"bm25_{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "bm25.json"), "w") as f:
+            # Term ids are assigned in insertion order
+            json.dump({"vocab": list(self.vocab)}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map postings written by save()."""
+        self = cls.__new__(cls)
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"bm25_{name}.npy"), mmap_mode="r"))
+        with open(os.path.join(path, "bm25.json")) as f:
+            self.vocab = {term: i for i, term in enumerate(json.load(f)["vocab"])}
+        self._init_stats()
+        return self
+
+    def df(self, term):
+        t = self.vocab.get(term)
+        return 0 if t is None else int(self.indptr[t + 1] - self.indptr[t])
+
+    def _terms(self, query, stats):
+        """(start, end, idf) of the posting list of each query term."""
+        return [(self.indptr[t], self.indptr[t + 1], stats.idf(term))
+                for term in set(tokenize(query)) if (t := self.vocab.get(term)) is not None]
+
+    def _weights(self, postings, idf, stats):
+        """BM25 terms of the postings at `postings` (a slice or positions)."""
+        tf = self.tfs[postings]
+        return idf * tf * (stats.k1 + 1) / (tf + stats.norm(self)[self.doc_ids[postings]])
+
+    def search(self, query, k, allowed=None, stats=None):
+        """(rows, scores) of the k best-scoring documents, best first, out
+        of the rows allowed (a bool mask; default all). Documents sharing
+        no term with the query are never returned. Scores are against
+        stats (default: this index's own)."""
+        stats = stats or self.stats
+        terms = self._terms(query, stats)
+        if not terms:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        docs = np.concatenate([self.doc_ids[lo:hi] for lo, hi, _ in terms])
+        weights = np.concatenate([self._weights(slice(lo, hi), idf, stats) for lo, hi, idf in terms])
+        if len(docs) * 8 > self.n_docs:
+            # Dense accumulation is cheaper once postings cover much of the corpus
+            scores = np.bincount(docs, weights, minlength=self.n_docs)
+            rows = np.flatnonzero(scores)
+            scores = scores[rows]
+        else:
+            rows, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights)
+        if allowed is not None:
+            keep = allowed[rows]
+            rows, scores = rows[keep], scores[keep]
+        best = top_k(scores, k)
+        return rows[best].astype(np.int64), scores[best].astype(np.float32)
+
+    def score_rows(self, query, rows, stats=None):
+        """Exact BM25 scores of the given documents."""
+        stats = stats or self.stats
+        scores = np.zeros(len(rows), dtype=np.float32)
+        for lo, hi, idf in self._terms(query, stats):
+            posting = self.doc_ids[lo:hi]
+            pos = np.searchsorted(posting, rows)
+            found = pos < len(posting)
+            found[found] = posting[pos[found]] == rows[found]
+            scores[found] += self._weights(lo + pos[found], idf, stats)
+        return scores
+
+RRF_K = 60
+FUSION_DEPTH = 100  # candidates taken from each retriever before fusing
+
+# BM25 runs here while the calling thread does the vector scan; both spend
+# most of their time in numpy, which releases the GIL. One thread per
+# request thread (run_in_threadpool allows 40), so concurrent fused
+# searches never queue behind each other's BM25; threads start on demand.
+BM25_THREADS = int(os.getenv("BM25_THREADS", "40"))
+_executor = ThreadPoolExecutor(max_workers=BM25_THREADS, thread_name_prefix="bm25")
+
+def search_later(index, queries, k, allowed=None):
+    """Future of index.search(query, k, allowed) for each query."""
+    return _executor.submit(lambda: [index.search(q, k, allowed) for q in queries])
+
+def fuse(mode, vector_rows, lexical_rows, k, vector_score, lexical, query, alpha=0.5):
+    """The k best (rows, scores) of both retrievers' top lists.
+
+    "rrf": sum of 1 / (RRF_K + rank) over the lists a row is in.
+    "weighted": alpha * cosine + (1 - alpha) * BM25 / best BM25, both
+    computed exactly for every candidate from either list. vector_score
+    maps sorted rows to their cosines; lexical is the BM25Index.
+    """
+    if mode == "rrf":
+        fused = {}
+        for ranked in (vector_rows, lexical_rows):
+            for rank, row in enumerate(ranked.tolist(), 1):
+                fused[row] = fused.get(row, 0.0) + 1 / (RRF_K + rank)
+        rows = np.fromiter(fused, dtype=np.int64, count=len(fused))
+        scores = np.fromiter(fused.values(), dtype=np.float64, count=len(fused))
+    else:
+        rows = np.union1d(vector_rows, lexical_rows)
+        bm25 = lexical.score_rows(query, rows)
+        best = bm25.max() if len(bm25) else 0
+        scores = alpha * vector_score(rows) + (1 - alpha) * (bm25 / best if best > 0 else bm25)
+    best = top_k(scores, k)
+    return rows[best], scores[best]
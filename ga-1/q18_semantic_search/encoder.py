@@ -0,0 +1,128 @@
+"""Micro-batching query encoder.
+
+Requests put their queries on a queue and await futures instead of
+running the model on the event loop. One worker thread takes whatever is
+queued, waits up to ENCODE_MAX_WAIT_MS for more (or until
+ENCODE_MAX_BATCH texts), encodes them in a single model call and resolves
+each request's future with its rows. Under concurrency many requests
+share one forward pass; a lone request pays at most the wait.
+
+A request's texts are never split: all queries of a /search/batch call
+go through one model call, even past ENCODE_MAX_BATCH, which only stops
+further requests from joining. Requests cancelled while queued (a client
+that went away) are dropped before encoding.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from index import encode
+
+ENCODE_MAX_BATCH = int(os.getenv("ENCODE_MAX_BATCH", "32"))
+ENCODE_MAX_WAIT_MS = float(os.getenv("ENCODE_MAX_WAIT_MS", "5"))
+STATS_WINDOW = 1000  # recent batches kept for the report
+
+def _percentiles(values):
+    if not values:
+        return {"p50": 0, "p95": 0, "p99": 0}
+    values = np.array(values)
+    return {p: round(float(np.percentile(values, q)), 3) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+
+class BatchEncoder:
+    def __init__(self, max_batch=ENCODE_MAX_BATCH, max_wait_ms=ENCODE_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.max_seen = 0
+        self.recent = deque(maxlen=STATS_WINDOW)  # (start, end, size) per batch
+        self.waits = deque(maxlen=STATS_WINDOW * 4)  # ms from enqueue to batch start
+        self.worker = threading.Thread(target=self._run, name="encoder", daemon=True)
+        self.worker.start()
+
+    def submit(self, texts):
+        """Future of the (len(texts), dim) normalized embeddings of texts."""
+        future = Future()
+        self.queue.put((texts, future, time.perf_counter()))
+        return future
+
+    async def encode(self, texts):
+        """(len(texts), dim) embeddings, without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(list(texts)))
+
+    def _collect(self):
+        """Queued requests for one model call, minus cancelled ones; once
+        taken, a request can no longer be cancelled."""
+        batch, size = [], 0
+        deadline = None
+        while size < self.max_batch:
+            if deadline is None:
+                item = self.queue.get()
+            else:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+                size += len(item[0])
+                if deadline is None:
+                    deadline = time.perf_counter() + self.max_wait
+        return batch
+
+    def _run(self):
+        # Nothing may end this thread: every later request would hang
+        while True:
+            try:
+                self._encode_batch(self._collect())
+            except Exception as e:
+                print(f"Encoder error: {e}")
+
+    def _encode_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            vectors = encode([text for texts, _, _ in batch for text in texts])
+        except Exception as e:
+            print(f"Encoding failed: {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        offset = 0
+        for texts, future, _ in batch:
+            future.set_result(vectors[offset:offset + len(texts)])
+            offset += len(texts)
+        end = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.texts += offset
+            self.max_seen = max(self.max_seen, offset)
+            self.recent.append((start, end, offset))
+            self.waits.extend((start - queued) * 1000 for _, _, queued in batch)
+
+    def stats(self):
+        with self.lock:
+            recent = list(self.recent)
+            waits = list(self.waits)
+            report = {"batches": self.batches, "texts": self.texts, "maxBatchSize": self.max_seen,
+                      "maxBatch": self.max_batch, "maxWaitMs": self.max_wait * 1000}
+        sizes = [size for _, _, size in recent]
+        span = recent[-1][1] - recent[0][0] if recent else 0
+        report.update({
+            "avgBatchSize": round(sum(sizes) / len(sizes), 2) if sizes else 0,
+            "queueWaitMs": _percentiles(waits),
+            "encodeMs": _percentiles([(end - start) * 1000 for start, end, _ in recent]),
+            # Texts per second over the recent batches, idle gaps included
+            "throughput": round(sum(sizes) / span, 1) if span > 0 else 0,
+        })
+        return report
+
+query_encoder = BatchEncoder()
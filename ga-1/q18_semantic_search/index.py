@@ -0,0 +1,197 @@
+"""Persisted document index.
+
+`python index.py` (or the first server start) encodes the corpus once and
+writes INDEX_DIR:
+  embeddings.npy     L2-normalized float32 embeddings (n x dim)
+  ids.npy            document ids
+  offsets.npy        byte offsets of each document's content in content.bin
+  content.bin        UTF-8 contents, concatenated
+  meta_offsets.npy   byte offsets of each document's metadata in metadata.bin
+  metadata.bin       metadata as JSON, concatenated
+  bm25_*.npy, bm25.json      BM25 postings and vocabulary (bm25.py)
+  filters.bin, filters.json  metadata value index (filters.py)
+  meta.json          format version, model, dimension, count and a
+                     fingerprint of the corpus
+
+The server memory-maps these files. It rebuilds them only when the
+format version, the model or the corpus fingerprint changed, so a warm
+start neither re-encodes anything nor loads the model before the first
+query needs it.
+"""
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+VERSION = 2
+INDEX_DIR = os.getenv("INDEX_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_data")
+MODEL_NAME = "all-MiniLM-L6-v2"
+MOCK_DIM = 384
+ENCODE_BATCH = 256
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+
+def model_id():
+    """Name of the model embeddings come from ("mock" without one)."""
+    if importlib.util.find_spec("sentence_transformers") is None:
+        return "mock"
+    return MODEL_NAME
+
+def get_model():
+    """The SentenceTransformer, loaded on first use; None if not installed."""
+    global _model, _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            try:
+                from sentence_transformers import SentenceTransformer
+                print("Loading model...")
+                _model = SentenceTransformer(MODEL_NAME)
+            except ImportError:
+                print("SentenceTransformers not found. Using mock embeddings.")
+            _model_loaded = True
+    return _model
+
+def _mock_embedding(text):
+    # Deterministic per text, so mock results are at least repeatable
+    seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).random(MOCK_DIM, dtype=np.float32)
+
+def encode(texts):
+    """L2-normalized float32 embeddings of texts, (n, dim)."""
+    model = get_model()
+    if model:
+        vecs = model.encode(texts, batch_size=64, convert_to_numpy=True).astype(np.float32)
+    else:
+        vecs = np.stack([_mock_embedding(t) for t in texts]) if texts else np.zeros((0, MOCK_DIM), np.float32)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first, along the last axis.
+
+    argpartition finds the k in O(n); only those k are then sorted.
+    """
+    n = scores.shape[-1]
+    k = max(0, min(k, n))
+    if k == 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, candidates, -1), axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, -1)
+
+def fingerprint(docs):
+    h = hashlib.sha1()
+    for doc in docs:
+        h.update(json.dumps([doc["id"], doc["content"], doc["metadata"]], sort_keys=True).encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+def _write_blob(path, offsets_path, items):
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in items], out=offsets[1:])
+    with open(path, "wb") as f:
+        for b in items:
+            f.write(b)
+    np.save(offsets_path, offsets)
+
+def build(docs, path=INDEX_DIR, embeddings=None):
+    """Write the index of docs to path, replacing any old one. Contents
+    are encoded unless their normalized embeddings are given."""
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    n = len(docs)
+    if embeddings is not None:
+        np.save(os.path.join(tmp, "embeddings.npy"), np.asarray(embeddings, dtype=np.float32))
+        dim = embeddings.shape[1]
+    else:
+        first = encode([d["content"] for d in docs[:ENCODE_BATCH]])
+        dim = first.shape[1]
+        emb = np.lib.format.open_memmap(os.path.join(tmp, "embeddings.npy"), mode="w+",
+                                        dtype=np.float32, shape=(n, dim))
+        emb[:len(first)] = first
+        for start in range(ENCODE_BATCH, n, ENCODE_BATCH):
+            batch = docs[start:start + ENCODE_BATCH]
+            emb[start:start + len(batch)] = encode([d["content"] for d in batch])
+        emb.flush()
+        del emb
+
+    np.save(os.path.join(tmp, "ids.npy"), np.array([d["id"] for d in docs], dtype=np.int64))
+    _write_blob(os.path.join(tmp, "content.bin"), os.path.join(tmp, "offsets.npy"),
+                [d["content"].encode() for d in docs])
+    _write_blob(os.path.join(tmp, "metadata.bin"), os.path.join(tmp, "meta_offsets.npy"),
+                [json.dumps(d["metadata"]).encode() for d in docs])
+    # Imported here: bm25 imports this module
+    from bm25 import BM25Index
+    from filters import MetadataIndex
+    BM25Index(d["content"] for d in docs).save(tmp)
+    MetadataIndex(d["metadata"] for d in docs).save(tmp)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"version": VERSION, "model": model_id(), "dim": dim, "count": n,
+                   "fingerprint": fingerprint(docs)}, f)
+
+    old = path + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+def _blob(path):
+    # np.memmap cannot map an empty file
+    return np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else b""
+
+class DocIndex:
+    """Read-only view of a built index; everything is memory-mapped."""
+
+    def __init__(self, path=INDEX_DIR):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self._content = _blob(os.path.join(path, "content.bin"))
+        self._meta_offsets = np.load(os.path.join(path, "meta_offsets.npy"), mmap_mode="r")
+        self._metadata = _blob(os.path.join(path, "metadata.bin"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def content(self, row):
+        return bytes(self._content[self._offsets[row]:self._offsets[row + 1]]).decode()
+
+    def metadata(self, row):
+        return json.loads(bytes(self._metadata[self._meta_offsets[row]:self._meta_offsets[row + 1]]))
+
+    def doc(self, row):
+        return {"id": int(self.ids[row]), "content": self.content(row), "metadata": self.metadata(row)}
+
+def is_current(docs, path=INDEX_DIR):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (meta.get("version") == VERSION and meta.get("model") == model_id()
+            and meta.get("count") == len(docs) and meta.get("fingerprint") == fingerprint(docs))
+
+def load_or_build(docs, path=INDEX_DIR):
+    if not is_current(docs, path):
+        print("Building document index...")
+        build(docs, path)
+    return DocIndex(path)
+
+if __name__ == "__main__":
+    import main  # builds the index if it is missing or stale
+    print(f"{len(main.doc_index)} documents indexed in {INDEX_DIR} ({main.doc_index.meta['model']})")
@@ -1,11 +1,31 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Literal, Optional
+from functools import partial
+import json
 import time
 import numpy as np
 
-app = FastAPI()
+from index import load_or_build, top_k
+from bm25 import FUSION_DEPTH, fuse, search_later
+from encoder import query_encoder
+from filters import FILTER_GATHER_MAX
+from result_cache import normalize, result_cache
+from rerank import rerank as cross_encoder_rerank, rerank_stats, pair_cache, RERANK_BUDGET_MS
+from segments import SegmentStore
+from shards import SEARCH_PROCESSES, ShardPool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Stop the shard workers with the server, not at interpreter exit
+    if shard_pool:
+        shard_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,49 +67,45 @@ def generate_docs():
 documents = generate_docs()
 
 # --- Semantic Search Setup ---
-try:
-    from sentence_transformers import SentenceTransformer
-    print("Loading model...")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    print("Computing embeddings...")
-    doc_contents = [doc['content'] for doc in documents]
-    doc_embeddings = model.encode(doc_contents)
-except ImportError:
-    print("SentenceTransformers not found. Using mock embeddings.")
-    # Mock embeddings: random vectors
-    model = None
-    doc_embeddings = np.random.rand(len(documents), 384).astype('float32')
-
-# --- Re-ranking Simulation ---
-def simulated_rerank(query: str, candidates: List[dict], k: int) -> List[dict]:
-    reranked_candidates = []
-    for doc in candidates:
-        original_score = doc['score']
-        # Simple boost logic for semantic relevance
-        boost = 0.0
-        if "climate" in query.lower() and "climate" in doc['content'].lower():
-            boost = 0.2
-        elif "liability" in query.lower() and "liability" in doc['content'].lower():
-            boost = 0.1
-        
-        new_score = min(0.99, original_score + boost)
-        reranked_candidates.append({
-            "id": doc['id'],
-            "score": round(new_score, 2),
-            "content": doc['content'],
-            "metadata": doc['metadata']
-        })
-    
-    # Sort by new score descending
-    reranked_candidates.sort(key=lambda x: x['score'], reverse=True)
-    return reranked_candidates[:k]
+# Normalized embeddings are memory-mapped from the persisted index, which
+# is only rebuilt when the corpus or model changes. The model itself is
+# loaded when the first query has to be encoded.
+doc_index = load_or_build(documents)
+# Documents added through the API live in segments on top of it; each
+# search reads one consistent snapshot of both (see segments.py)
+corpus = SegmentStore(doc_index)
+# With SEARCH_PROCESSES > 1, unfiltered vector scans are split across
+# that many worker processes (see shards.py)
+shard_pool = ShardPool(SEARCH_PROCESSES) if SEARCH_PROCESSES > 1 else None
 
 # --- API Models ---
+class Document(BaseModel):
+    id: Optional[int] = None  # default: next free id; an existing id is replaced
+    content: str
+    metadata: dict = {}
+
+class AddDocumentsRequest(BaseModel):
+    documents: List[Document]
+
 class SearchRequest(BaseModel):
     query: str
     k: int = 6
     rerank: bool = False
     rerankK: int = 4
+    rerankBudgetMs: Optional[float] = None  # default: RERANK_BUDGET_MS
+    fusion: Optional[Literal["rrf", "weighted"]] = None  # None: vector only
+    alpha: float = 0.5  # vector weight for "weighted" fusion
+    filter: Optional[Dict[str, Any]] = None  # metadata field -> value or list of values
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    k: int = 6
+    rerank: bool = False
+    rerankK: int = 4
+    rerankBudgetMs: Optional[float] = None  # default: RERANK_BUDGET_MS
+    fusion: Optional[Literal["rrf", "weighted"]] = None  # None: vector only
+    alpha: float = 0.5  # vector weight for "weighted" fusion
+    filter: Optional[Dict[str, Any]] = None  # metadata field -> value or list of values
 
 class SearchResult(BaseModel):
     id: int
@@ -102,41 +118,113 @@ class SearchResponse(BaseModel):
     reranked: bool
     metrics: dict
 
+class BatchSearchResponse(BaseModel):
+    results: List[List[SearchResult]]
+    reranked: bool
+    metrics: dict
+
+# --- Retrieval ---
+def retrieve(queries: List[str], query_embeddings: np.ndarray, k: int, rerank: bool, rerank_k: int,
+             budget_ms: Optional[float] = None, fusion: Optional[str] = None, alpha: float = 0.5,
+             filter: Optional[dict] = None):
+    """Result lists for queries, how many re-rankings fell back to
+    first-stage order, and how a filter was applied. Runs on a worker
+    thread, not the event loop."""
+    # Files of segments compacted away meanwhile stay until the block exits
+    with corpus.reading() as snapshot:
+        allowed = snapshot.select(filter) if filter else None
+        # With fusion, BM25 ranks candidates on its own thread meanwhile
+        depth = max(k, FUSION_DEPTH) if fusion else k
+        lexical = search_later(snapshot.lexical, queries, depth, allowed) if fusion else None
+
+        # 2. Vector Similarity: one (queries x docs) product; the dot product
+        # of unit vectors is the cosine
+        filtering = None
+        sharded = allowed is None and shard_pool is not None
+        if sharded:
+            # Local top lists from every shard process, merged here
+            top, top_scores = shard_pool.search(snapshot, query_embeddings, depth)
+        else:
+            if allowed is None:
+                scores = snapshot.scores(query_embeddings)
+                top = top_k(scores, depth)
+            else:
+                selected = np.flatnonzero(allowed)
+                if len(selected) <= FILTER_GATHER_MAX * len(allowed):
+                    # Selective filter: score only the selected rows
+                    strategy = "prefilter"
+                    subset = snapshot.scores(query_embeddings, selected)
+                    top = selected[top_k(subset, depth)]
+                    scores = np.full((len(queries), len(allowed)), -np.inf, dtype=np.float32)
+                    scores[:, selected] = subset
+                else:
+                    # Broad filter: a full scan is cheaper than the gather
+                    strategy = "postfilter"
+                    scores = snapshot.scores(query_embeddings)
+                    scores[:, ~allowed] = -np.inf
+                    top = top_k(scores, depth)
+                filtering = {"selected": len(selected), "strategy": strategy}
+            top_scores = np.take_along_axis(scores, top, -1)
+
+        def vector_score(i, rows):
+            # Sharded scans keep no full score row, so score these rows directly
+            if sharded:
+                return snapshot.scores(query_embeddings[i:i + 1], rows)[0]
+            return scores[i][rows]
+
+        lexical = lexical.result() if fusion else None
+
+        results = []
+        fallbacks = 0
+        # One re-rank budget for the whole request, however many queries
+        deadline = time.perf_counter() + (budget_ms or RERANK_BUDGET_MS) / 1000
+        for i, (query, rows, row_scores) in enumerate(zip(queries, top, top_scores)):
+            live = np.isfinite(row_scores)  # fewer live rows than depth
+            rows, row_scores = rows[live], row_scores[live]
+            if fusion:
+                # 2b. Fusion of the vector and BM25 rankings
+                rows, fused = fuse(fusion, rows, lexical[i][0], k, partial(vector_score, i),
+                                   snapshot.lexical, query, alpha)
+                ranked = [(row, round(float(score), 4)) for row, score in zip(rows, fused)]
+            else:
+                ranked = [(row, round(float(score), 2)) for row, score in zip(rows, row_scores)]
+            candidates = []
+            for idx, score in ranked:
+                doc = snapshot.doc(idx)
+                doc["score"] = score
+                candidates.append(doc)
+
+            # 3. Re-ranking: cross-encoder within the latency budget
+            if rerank:
+                candidates, fallback = cross_encoder_rerank(
+                    query, candidates, rerank_k, budget_ms or RERANK_BUDGET_MS, deadline)
+                fallbacks += fallback
+            results.append(candidates)
+        return results, fallbacks, filtering
+
 # --- Endpoints ---
 @app.post("/search", response_model=SearchResponse)
 async def search(request: SearchRequest):
     start_time = time.time()
     
-    # 1. Component Query Embedding
-    if model:
-        query_embedding = model.encode(request.query)
+    # 0. Result cache: same query and options against the same corpus version
+    version = corpus.snapshot.version
+    # alpha only changes "weighted" results; elsewhere it would just split entries
+    alpha = request.alpha if request.fusion == "weighted" else None
+    key = (normalize(request.query), request.k, request.rerank, request.rerankK, request.fusion,
+           alpha, json.dumps(request.filter, sort_keys=True))
+    cached = result_cache.get(key, version)
+    if cached is not None:
+        final_results, fallbacks, filtering = cached
     else:
-        # Mock query embedding
-        query_embedding = np.random.rand(384).astype('float32')
-
-    # 2. Vector Similarity (Cosine)
-    scores = np.dot(doc_embeddings, query_embedding)
-    
-    # Normalize scores to 0-1
-    # Since it's a demo, we'll just clip and shift for visual sanity
-    norm_scores = (scores - np.min(scores)) / (np.max(scores) - np.min(scores) + 1e-6)
-    
-    # Get top K candidates
-    top_k_indices = np.argsort(norm_scores)[::-1][:request.k]
-    
-    initial_results = []
-    for idx in top_k_indices:
-        initial_results.append({
-            "id": documents[idx]['id'],
-            "score": float(round(norm_scores[idx], 2)),
-            "content": documents[idx]['content'],
-            "metadata": documents[idx]['metadata']
-        })
-    
-    # 3. Re-ranking
-    final_results = initial_results
-    if request.rerank:
-        final_results = simulated_rerank(request.query, initial_results, request.rerankK)
+        # 1. Component Query Embedding: batched with concurrent requests' queries
+        query_embeddings = await query_encoder.encode([request.query])
+        results, fallbacks, filtering = await run_in_threadpool(
+            retrieve, [request.query], query_embeddings, request.k, request.rerank, request.rerankK,
+            request.rerankBudgetMs, request.fusion, request.alpha, request.filter)
+        final_results = results[0]
+        if not fallbacks:  # a re-rank that ran out of time may do better next time
+            result_cache.put(key, version, (final_results, fallbacks, filtering))
     
     latency_ms = int((time.time() - start_time) * 1000)
     
@@ -145,10 +233,66 @@ async def search(request: SearchRequest):
         "reranked": request.rerank,
         "metrics": {
             "latency": latency_ms,
-            "totalDocs": len(documents)
+            "totalDocs": corpus.snapshot.count,
+            "fusion": request.fusion,
+            "filter": filtering,
+            "rerankFallback": bool(fallbacks),
+            "cache": "hit" if cached is not None else "miss",
+            "cacheHitRate": result_cache.hit_rate()
         }
     }
 
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def search_batch(request: BatchSearchRequest):
+    start_time = time.time()
+
+    results, fallbacks, filtering = [], 0, None
+    if request.queries:
+        query_embeddings = await query_encoder.encode(request.queries)
+        results, fallbacks, filtering = await run_in_threadpool(
+            retrieve, request.queries, query_embeddings, request.k, request.rerank, request.rerankK,
+            request.rerankBudgetMs, request.fusion, request.alpha, request.filter)
+
+    latency_ms = int((time.time() - start_time) * 1000)
+
+    return {
+        "results": results,
+        "reranked": request.rerank,
+        "metrics": {
+            "latency": latency_ms,
+            "queries": len(request.queries),
+            "totalDocs": corpus.snapshot.count,
+            "fusion": request.fusion,
+            "filter": filtering,
+            "rerankFallbacks": fallbacks
+        }
+    }
+
+@app.post("/documents")
+def add_documents(request: AddDocumentsRequest):
+    """Encode and append documents; searches see them once this returns."""
+    if not request.documents:
+        raise HTTPException(status_code=400, detail="No documents given")
+    ids = corpus.add([doc.model_dump() for doc in request.documents])
+    return {"ids": ids, "totalDocs": corpus.snapshot.count}
+
+@app.delete("/documents/{doc_id}")
+def delete_document(doc_id: int):
+    if not corpus.delete(doc_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"deleted": doc_id, "totalDocs": corpus.snapshot.count}
+
+@app.get("/metrics")
+def metrics():
+    """Re-rank latency per rerankK, caches, corpus and query encoder."""
+    return {
+        "rerank": rerank_stats.report(),
+        "pairCache": pair_cache.stats(),
+        "corpus": corpus.stats(),
+        "encoder": query_encoder.stats(),
+        "resultCache": result_cache.stats()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,214 @@
+"""Second-stage re-ranking with a local cross-encoder.
+
+All uncached (query, candidate) pairs of a request are scored in one
+batched forward pass on a dedicated thread. If that takes longer than the
+latency budget, the request falls back to first-stage order; a pass that
+has started still finishes in the background and fills the pair-score
+cache, so the same query re-ranks properly next time, while one still
+queued is cancelled. With MAX_QUEUED_PASSES already waiting, a request
+falls back without submitting, so the queue cannot grow under load.
+Without sentence-transformers the keyword-boost simulation below is used
+instead.
+"""
+import importlib.util
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import List, Optional
+
+import numpy as np
+
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))
+PAIR_CACHE_SIZE = 50000
+LATENCY_WINDOW = 1000  # recent latencies kept per rerankK
+MAX_QUEUED_PASSES = 1  # passes allowed to wait behind the running one
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+# One forward pass at a time; a timed-out pass keeps the worker busy
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+_passes = 0  # submitted and not yet finished or cancelled
+_passes_lock = threading.Lock()
+
+def get_cross_encoder():
+    global _model, _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            if importlib.util.find_spec("sentence_transformers") is not None:
+                from sentence_transformers import CrossEncoder
+                print("Loading cross-encoder...")
+                _model = CrossEncoder(RERANK_MODEL)
+            _model_loaded = True
+    return _model
+
+class PairScoreCache:
+    """LRU of cross-encoder scores keyed by _pair(query, document)."""
+
+    def __init__(self, max_size=PAIR_CACHE_SIZE):
+        self.max_size = max_size
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            score = self.store.get(key)
+            if score is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store.move_to_end(key)
+            return score
+
+    def put_many(self, items):
+        with self.lock:
+            for key, score in items:
+                self.store[key] = score
+                self.store.move_to_end(key)
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.store), "hits": self.hits, "misses": self.misses,
+                    "hitRate": round(self.hits / lookups, 2) if lookups else 0}
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+class RerankStats:
+    """Re-rank latency per rerankK, so candidate depth can be set per SLA."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_k = {}
+
+    def record(self, rerank_k, candidates, latency_ms, fallback):
+        with self.lock:
+            stats = self.by_k.get(rerank_k)
+            if stats is None:
+                stats = self.by_k[rerank_k] = {
+                    "latencies": deque(maxlen=LATENCY_WINDOW), "count": 0,
+                    "candidates": 0, "fallbacks": 0
+                }
+            stats["latencies"].append(latency_ms)
+            stats["count"] += 1
+            stats["candidates"] += candidates
+            stats["fallbacks"] += fallback
+
+    def report(self):
+        with self.lock:
+            report = {}
+            for rerank_k, stats in sorted(self.by_k.items()):
+                lat = np.array(stats["latencies"])
+                report[str(rerank_k)] = {
+                    "count": stats["count"],
+                    "avgCandidates": round(stats["candidates"] / stats["count"], 1),
+                    "p50": round(float(np.percentile(lat, 50)), 2),
+                    "p95": round(float(np.percentile(lat, 95)), 2),
+                    "p99": round(float(np.percentile(lat, 99)), 2),
+                    "fallbackRate": round(stats["fallbacks"] / stats["count"], 3),
+                }
+            return report
+
+pair_cache = PairScoreCache()
+rerank_stats = RerankStats()
+
+# --- Re-ranking Simulation ---
+def simulated_rerank(query: str, candidates: List[dict], k: int) -> List[dict]:
+    reranked_candidates = []
+    for doc in candidates:
+        original_score = doc['score']
+        # Simple boost logic for semantic relevance
+        boost = 0.0
+        if "climate" in query.lower() and "climate" in doc['content'].lower():
+            boost = 0.2
+        elif "liability" in query.lower() and "liability" in doc['content'].lower():
+            boost = 0.1
+
+        new_score = min(0.99, original_score + boost)
+        reranked_candidates.append({
+            "id": doc['id'],
+            "score": round(new_score, 2),
+            "content": doc['content'],
+            "metadata": doc['metadata']
+        })
+
+    # Sort by new score descending
+    reranked_candidates.sort(key=lambda x: x['score'], reverse=True)
+    return reranked_candidates[:k]
+
+def _pair(query, doc):
+    # A re-posted id replaces the document's content, so the content is
+    # part of the key: a stale score is never served for the new text
+    return query, doc["id"], hash(doc["content"])
+
+def _score_pairs(model, query, pending):
+    logits = model.predict([(query, doc["content"]) for doc in pending], batch_size=len(pending))
+    scores = [1 / (1 + math.exp(-float(x))) for x in logits]
+    pair_cache.put_many((_pair(query, doc), s) for doc, s in zip(pending, scores))
+    return scores
+
+def _pass_done(future):
+    global _passes
+    with _passes_lock:
+        _passes -= 1
+
+def _submit(model, query, pending):
+    """Future of the forward pass, or None if the queue is already full."""
+    global _passes
+    with _passes_lock:
+        if _passes > MAX_QUEUED_PASSES:
+            return None
+        _passes += 1
+    future = _executor.submit(_score_pairs, model, query, pending)
+    future.add_done_callback(_pass_done)
+    return future
+
+def rerank(query: str, candidates: List[dict], k: int, budget_ms: float = RERANK_BUDGET_MS,
+           deadline: Optional[float] = None):
+    """Top k of candidates by cross-encoder score. Returns (results,
+    fallback), where fallback means the budget ran out and results are in
+    first-stage order. deadline, a time.perf_counter() value, caps the
+    wait when several calls share one budget."""
+    start = time.perf_counter()
+    model = get_cross_encoder()
+    if model is None:
+        results, fallback = simulated_rerank(query, candidates, k), False
+    else:
+        query = query.strip()
+        scores = {doc["id"]: pair_cache.get(_pair(query, doc)) for doc in candidates}
+        pending = [doc for doc in candidates if scores[doc["id"]] is None]
+        fallback = False
+        if pending:
+            out_of_time = deadline is not None and time.perf_counter() >= deadline
+            future = None if out_of_time else _submit(model, query, pending)
+            if future is None:
+                fallback = True
+            else:
+                remaining = budget_ms / 1000 - (time.perf_counter() - start)
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.perf_counter())
+                try:
+                    for doc, score in zip(pending, future.result(timeout=max(0.0, remaining))):
+                        scores[doc["id"]] = score
+                except TimeoutError:
+                    future.cancel()  # only a pass still queued; a running one fills the cache
+                    fallback = True
+
+        if fallback:
+            results = candidates[:k]
+        else:
+            ranked = sorted(candidates, key=lambda doc: scores[doc["id"]], reverse=True)[:k]
+            results = [dict(doc, score=round(scores[doc["id"]], 2)) for doc in ranked]
+
+    rerank_stats.record(k, len(candidates), (time.perf_counter() - start) * 1000, fallback)
+    return results, fallback
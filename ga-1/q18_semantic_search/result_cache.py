@@ -0,0 +1,61 @@
+"""LRU cache of /search results.
+
+Entries are keyed by the normalized query and every request field that
+changes the results, and tagged with the corpus version they were
+computed against: after any ingestion, deletion or compaction they stop
+matching and are dropped on their next lookup. A hit is one dict lookup
+under a lock, before any encoding or scoring. RESULT_CACHE_SIZE=0
+disables the cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000"))
+
+def normalize(query):
+    # all-MiniLM-L6-v2 lowercases its input, so case does not change results
+    return " ".join(query.lower().split())
+
+class ResultCache:
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        if not self.max_size:
+            return None
+        with self.lock:
+            entry = self.store.get(key)
+            if entry is not None and entry[0] != version:
+                del self.store[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, value):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.store[key] = (version, value)
+            self.store.move_to_end(key)
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 3) if lookups else 0
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.store), "maxSize": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "hitRate": self.hit_rate()}
+
+result_cache = ResultCache()
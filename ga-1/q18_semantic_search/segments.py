@@ -0,0 +1,319 @@
+"""Live corpus: the persisted base index plus appended segments.
+
+POST /documents writes each batch as a new segment under SEGMENT_DIR, in
+the same format as the base index, and DELETE /documents/{id} tombstones
+the document's row. Writers build a new immutable Snapshot and swap it
+in; a search takes the current snapshot once and never locks, so it sees
+either all of a change or none of it. Once COMPACT_SEGMENTS segments have
+been appended, a background thread merges them into one without the
+tombstoned rows; the merged directories are deleted once no search that
+took an older snapshot (see SegmentStore.reading) is still running. The
+base index itself is never rewritten.
+
+SEGMENT_DIR/manifest.json lists the segments and their deleted rows.
+"""
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+from bm25 import BM25Index, BM25Stats
+from filters import MetadataIndex
+from index import INDEX_DIR, DocIndex, build, encode, top_k
+
+SEGMENT_DIR = os.getenv("SEGMENT_DIR") or INDEX_DIR + "_segments"
+COMPACT_SEGMENTS = 4
+
+def _open(cls, index, values):
+    """cls.load() the structure build() wrote next to index; a segment
+    written before those were persisted gets them built and saved once."""
+    try:
+        return cls.load(index.path)
+    except FileNotFoundError:
+        built = cls(values(row) for row in range(len(index)))
+        built.save(index.path)
+        return built
+
+class Segment:
+    """A built index with its BM25 postings, metadata index and id -> row
+    lookup."""
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.lexical = _open(BM25Index, index, index.content)
+        self.metadata = _open(MetadataIndex, index, index.metadata)
+        self.rows = {int(doc_id): row for row, doc_id in enumerate(index.ids)}
+
+    def __len__(self):
+        return len(self.index)
+
+class Snapshot:
+    """Immutable view of the corpus. Rows are numbered across segments in
+    order; live[i] is segment i's mask of rows not deleted."""
+
+    def __init__(self, segments, live, version):
+        self.segments = tuple(segments)
+        self.live = tuple(live)
+        self.version = version
+        self.offsets = np.zeros(len(self.segments) + 1, dtype=np.int64)
+        np.cumsum([len(seg) for seg in self.segments], out=self.offsets[1:])
+        self.deleted = [len(mask) - int(mask.sum()) for mask in self.live]
+        self.count = int(self.offsets[-1]) - sum(self.deleted)
+        self.lexical = _Lexical(self)
+
+    def select(self, clause):
+        """Bool mask of the live rows whose metadata matches clause."""
+        return np.concatenate([seg.metadata.mask(clause) & live
+                               for seg, live in zip(self.segments, self.live)])
+
+    def scores(self, query_embeddings, rows=None):
+        """Cosine of every (query, row), -inf for deleted rows. With rows
+        (sorted, live), only those columns are computed and returned."""
+        if rows is not None:
+            return self._gather_scores(query_embeddings, rows)
+        parts = []
+        for seg, live, deleted in zip(self.segments, self.live, self.deleted):
+            emb = seg.index.embeddings
+            if len(query_embeddings) == 1:
+                part = np.dot(emb, query_embeddings[0])[None, :]
+            else:
+                part = np.dot(query_embeddings, emb.T)
+            if deleted:
+                part[:, ~live] = -np.inf
+            parts.append(part)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=1)
+
+    def _gather_scores(self, query_embeddings, rows):
+        parts = []
+        bounds = np.searchsorted(rows, self.offsets)
+        for i, seg in enumerate(self.segments):
+            local = rows[bounds[i]:bounds[i + 1]] - self.offsets[i]
+            emb = np.take(seg.index.embeddings, local, axis=0)
+            parts.append(np.dot(query_embeddings, emb.T))
+        return np.concatenate(parts, axis=1)
+
+    def locate(self, row):
+        i = int(np.searchsorted(self.offsets, row, side="right")) - 1
+        return i, int(row - self.offsets[i])
+
+    def doc(self, row):
+        i, local = self.locate(row)
+        return self.segments[i].index.doc(local)
+
+class _Lexical:
+    """BM25 over a snapshot, with the BM25Index interface fuse() uses.
+    Every segment is scored against the snapshot-wide statistics."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.stats = BM25Stats(seg.lexical for seg in snapshot.segments)
+
+    def search(self, query, k, allowed=None):
+        snap = self.snapshot
+        rows, scores = [], []
+        for i, seg in enumerate(snap.segments):
+            if allowed is None:
+                local, local_scores = seg.lexical.search(query, k + snap.deleted[i], stats=self.stats)
+                keep = snap.live[i][local]
+                local, local_scores = local[keep], local_scores[keep]
+            else:
+                local, local_scores = seg.lexical.search(
+                    query, k, allowed[snap.offsets[i]:snap.offsets[i + 1]], self.stats)
+            rows.append(local + snap.offsets[i])
+            scores.append(local_scores)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def score_rows(self, query, rows):
+        snap = self.snapshot
+        scores = np.zeros(len(rows), dtype=np.float32)
+        for i, seg in enumerate(snap.segments):
+            inside = (rows >= snap.offsets[i]) & (rows < snap.offsets[i + 1])
+            if inside.any():
+                scores[inside] = seg.lexical.score_rows(query, rows[inside] - snap.offsets[i], self.stats)
+        return scores
+
+class SegmentStore:
+    """Owns the current snapshot. Only writers take the lock."""
+
+    def __init__(self, base, path=SEGMENT_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.compacting = False
+        # Searches in flight per snapshot version, and segments compaction
+        # dropped as of a version: (version, names). Guarded by _readers_lock,
+        # which unlike lock is never held across I/O.
+        self._readers_lock = threading.Lock()
+        self._readers = Counter()
+        self._retired = []
+        try:
+            with open(os.path.join(path, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {"segments": []}
+        self.next_segment = manifest.get("next", 0)
+
+        segments = [Segment("base", base)]
+        for entry in manifest["segments"]:
+            if entry["name"] != "base":
+                segments.append(Segment(entry["name"], DocIndex(os.path.join(path, entry["name"]))))
+        live = [np.ones(len(seg), dtype=bool) for seg in segments]
+        deleted = {entry["name"]: entry["deleted"] for entry in manifest["segments"]}
+        # Base deletions only apply to the base they were made against
+        if manifest.get("base") != base.meta["fingerprint"]:
+            deleted.pop("base", None)
+        for seg, mask in zip(segments, live):
+            mask[deleted.get(seg.name, [])] = False
+        self.next_id = 1 + max((int(seg.index.ids.max()) for seg in segments if len(seg)), default=-1)
+        self.snapshot = Snapshot(segments, live, version=0)
+
+    @contextmanager
+    def reading(self):
+        """The current snapshot, whose segment files stay on disk until
+        the block exits (shard workers open them lazily)."""
+        with self._readers_lock:
+            snap = self.snapshot
+            self._readers[snap.version] += 1
+        try:
+            yield snap
+        finally:
+            with self._readers_lock:
+                self._readers[snap.version] -= 1
+                if not self._readers[snap.version]:
+                    del self._readers[snap.version]
+                doomed = self._collect()
+            self._remove(doomed)
+
+    def _collect(self):
+        """Pop the retired segments no running search can reach; the
+        caller holds _readers_lock and deletes them afterwards."""
+        oldest = min(self._readers, default=self.snapshot.version)
+        doomed = [names for version, names in self._retired if version <= oldest]
+        self._retired = [(version, names) for version, names in self._retired if version > oldest]
+        return [name for names in doomed for name in names]
+
+    def _remove(self, names):
+        for name in names:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _publish(self, snap):
+        self.snapshot = snap
+        manifest = {
+            "base": snap.segments[0].index.meta["fingerprint"],
+            "next": self.next_segment,
+            "segments": [{"name": seg.name, "deleted": np.flatnonzero(~mask).tolist()}
+                         for seg, mask in zip(snap.segments, snap.live)],
+        }
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, "manifest.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.path, "manifest.json"))
+
+    @staticmethod
+    def _tombstone(snap, live, doc_ids):
+        """Clear the live rows of doc_ids in live (copying masks of snap
+        before changing them). Returns how many rows were cleared."""
+        cleared = 0
+        for i, seg in enumerate(snap.segments):
+            for doc_id in doc_ids:
+                row = seg.rows.get(doc_id)
+                if row is not None and live[i][row]:
+                    if live[i] is snap.live[i]:
+                        live[i] = live[i].copy()
+                    live[i][row] = False
+                    cleared += 1
+        return cleared
+
+    def add(self, docs):
+        """Append docs ({"content", "metadata", optional "id"}) as a new
+        segment; a doc whose id already exists replaces it. Returns the ids."""
+        embeddings = encode([d["content"] for d in docs])
+        with self.lock:
+            name = f"seg_{self.next_segment:06d}"
+            self.next_segment += 1
+            docs = [dict(d) for d in docs]
+            for d in docs:
+                if d.get("id") is None:
+                    d["id"] = self.next_id
+                self.next_id = max(self.next_id, d["id"] + 1)
+        build(docs, os.path.join(self.path, name), embeddings)
+        segment = Segment(name, DocIndex(os.path.join(self.path, name)))
+
+        with self.lock:
+            snap = self.snapshot
+            live = list(snap.live)
+            self._tombstone(snap, live, [d["id"] for d in docs])
+            self._publish(Snapshot(snap.segments + (segment,), live + [np.ones(len(segment), dtype=bool)],
+                                   snap.version + 1))
+        self._maybe_compact()
+        return [d["id"] for d in docs]
+
+    def delete(self, doc_id):
+        """Tombstone a document; False if there is no such document."""
+        with self.lock:
+            snap = self.snapshot
+            live = list(snap.live)
+            if not self._tombstone(snap, live, [doc_id]):
+                return False
+            self._publish(Snapshot(snap.segments, live, snap.version + 1))
+        self._maybe_compact()
+        return True
+
+    def _maybe_compact(self):
+        with self.lock:
+            if self.compacting or len(self.snapshot.segments) - 1 < COMPACT_SEGMENTS:
+                return
+            self.compacting = True
+            name = f"seg_{self.next_segment:06d}"
+            self.next_segment += 1
+        threading.Thread(target=self._compact, args=(name,), daemon=True).start()
+
+    def _compact(self, name):
+        """Merge all appended segments into one, leaving out deleted rows."""
+        try:
+            snap = self.snapshot
+            merged = snap.segments[1:]
+            kept = [np.flatnonzero(mask) for mask in snap.live[1:]]
+            docs = [seg.index.doc(row) for seg, rows in zip(merged, kept) for row in rows]
+            segment = None
+            if docs:
+                embeddings = np.concatenate([seg.index.embeddings[rows] for seg, rows in zip(merged, kept)])
+                build(docs, os.path.join(self.path, name), embeddings)
+                segment = Segment(name, DocIndex(os.path.join(self.path, name)))
+
+            with self.lock:
+                current = self.snapshot
+                index = {seg.name: i for i, seg in enumerate(current.segments)}
+                segments, live = [current.segments[0]], [current.live[0]]
+                if segment is not None:
+                    # Rows deleted while merging stay deleted
+                    segments.append(segment)
+                    live.append(np.concatenate([current.live[index[seg.name]][rows]
+                                                for seg, rows in zip(merged, kept)]))
+                done = {seg.name for seg in merged}
+                for seg, mask in zip(current.segments[1:], current.live[1:]):
+                    if seg.name not in done:
+                        segments.append(seg)
+                        live.append(mask)
+                self._publish(Snapshot(segments, live, current.version + 1))
+            # Older snapshots still list the merged segments
+            with self._readers_lock:
+                self._retired.append((current.version + 1, [seg.name for seg in merged]))
+                doomed = self._collect()
+            self._remove(doomed)
+        except Exception as e:
+            print(f"Compaction failed: {e}")
+        finally:
+            self.compacting = False
+
+    def stats(self):
+        snap = self.snapshot
+        return {"version": snap.version, "segments": len(snap.segments),
+                "documents": snap.count, "tombstones": sum(snap.deleted)}
@@ -0,0 +1,98 @@
+"""Sharded vector search across worker processes.
+
+With SEARCH_PROCESSES > 1 the corpus rows of a snapshot are split into
+one contiguous shard per worker. Each worker memory-maps the segments'
+embeddings.npy files itself (the OS page cache is shared, nothing is
+copied into the workers), scores its shard and returns only its local
+top-k; the coordinator merges those into the global top-k. Deleted rows
+travel with the shard as a live mask.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from index import top_k
+
+SEARCH_PROCESSES = int(os.getenv("SEARCH_PROCESSES", "0"))
+MAX_OPEN_FILES = 64
+
+_maps = {}
+
+def _embeddings(path):
+    emb = _maps.get(path)
+    if emb is None:
+        if len(_maps) >= MAX_OPEN_FILES:
+            _maps.clear()  # old snapshots' files, e.g. compacted segments
+        emb = _maps[path] = np.load(path, mmap_mode="r")
+    return emb
+
+def search_shard(pieces, query_embeddings, k):
+    """Local top-k (rows, scores), (queries x k), of one shard. pieces are
+    (embeddings path, start, end, global offset, live mask or None)."""
+    rows, scores = [], []
+    for path, start, end, offset, live in pieces:
+        part = np.dot(query_embeddings, _embeddings(path)[start:end].T)
+        if live is not None:
+            part[:, ~live] = -np.inf
+        best = top_k(part, k)
+        rows.append(best + (offset + start))
+        scores.append(np.take_along_axis(part, best, -1))
+    return np.concatenate(rows, axis=1), np.concatenate(scores, axis=1)
+
+def merge(rows, scores, k):
+    best = top_k(scores, k)
+    return np.take_along_axis(rows, best, -1), np.take_along_axis(scores, best, -1)
+
+def plan(snapshot, shards):
+    """Split the snapshot's rows into at most `shards` contiguous shards
+    of about equal size."""
+    total = int(snapshot.offsets[-1])
+    bounds = np.linspace(0, total, min(shards, max(total, 1)) + 1).astype(np.int64)
+    tasks = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        pieces = []
+        for i, seg in enumerate(snapshot.segments):
+            seg_lo, seg_hi = snapshot.offsets[i], snapshot.offsets[i + 1]
+            start, end = max(lo, seg_lo), min(hi, seg_hi)
+            if start >= end:
+                continue
+            live = snapshot.live[i][start - seg_lo:end - seg_lo]
+            pieces.append((os.path.join(seg.index.path, "embeddings.npy"), int(start - seg_lo),
+                           int(end - seg_lo), int(seg_lo), None if live.all() else live))
+        if pieces:
+            tasks.append(pieces)
+    return tasks
+
+class ShardPool:
+    def __init__(self, processes=SEARCH_PROCESSES):
+        self.processes = processes
+        # The server already runs encoder, BM25 and rerank threads (and
+        # torch's), so forking it could copy a held lock into a worker.
+        # A forkserver that preloads only this module (numpy and index)
+        # forks workers from a clean single-threaded process instead.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["shards"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        self.planned = (None, None)
+
+    def search(self, snapshot, query_embeddings, k):
+        """Global top-k (rows, scores), (queries x k); deleted rows score -inf."""
+        planned_for, tasks = self.planned
+        if planned_for is not snapshot:
+            tasks = plan(snapshot, self.processes)
+            self.planned = (snapshot, tasks)
+        if not tasks:
+            empty = np.empty((len(query_embeddings), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        futures = [self.pool.submit(search_shard, pieces, query_embeddings, k) for pieces in tasks]
+        results = [f.result() for f in futures]
+        return merge(np.concatenate([r for r, _ in results], axis=1),
+                     np.concatenate([s for _, s in results], axis=1), k)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
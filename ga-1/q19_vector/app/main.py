@@ -1,9 +1,12 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 import os
+import time
 from dotenv import load_dotenv
+import openai
 from openai import OpenAI
 import numpy as np
 
@@ -26,12 +29,26 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Initialize OpenAI client with aipipe.org
+# Initialize OpenAI client with aipipe.org; embed_chunk does the retrying,
+# so the client's own retries would multiply its attempts
 client = OpenAI(
     api_key=os.getenv('AIPIPE_TOKEN'),
-    base_url=os.getenv('AIPIPE_BASE_URL', 'https://aipipe.org/openai/v1')
+    base_url=os.getenv('AIPIPE_BASE_URL', 'https://aipipe.org/openai/v1'),
+    max_retries=0
 )
 
+# Upstream limits: at most 2048 inputs per embeddings request, and a total
+# token cap per request; characters are a cheap proxy for tokens (~4 each)
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '256'))
+EMBED_BATCH_CHARS = int(os.getenv('EMBED_BATCH_CHARS', '200000'))
+EMBED_RETRIES = 3         # attempts per chunk
+EMBED_CONCURRENCY = 4     # chunks in flight at once
+
+# Errors worth another attempt; anything else (e.g. a bad input) is not
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+# Errors caused by some input in the request, e.g. a text over the token limit
+INPUT_ERRORS = (openai.BadRequestError, openai.UnprocessableEntityError)
+
 # Define request/response models using Pydantic
 class SimilarityRequest(BaseModel):
     docs: List[str]  # Array of document texts
@@ -40,22 +57,80 @@ class SimilarityRequest(BaseModel):
 class SimilarityResponse(BaseModel):
     matches: List[str]  # Top 3 matching documents
 
-def get_embedding(text: str) -> List[float]:
+def chunk_texts(texts: List[str]) -> List[List[int]]:
+    """
+    Split text indices into chunks that fit one embeddings request.
+    
+    A chunk ends when it reaches EMBED_BATCH_SIZE texts or adding the next
+    text would exceed EMBED_BATCH_CHARS characters.
+    """
+    chunks, current, chars = [], [], 0
+    for i, text in enumerate(texts):
+        if current and (len(current) >= EMBED_BATCH_SIZE or chars + len(text) > EMBED_BATCH_CHARS):
+            chunks.append(current)
+            current, chars = [], 0
+        current.append(i)
+        chars += len(text)
+    if current:
+        chunks.append(current)
+    return chunks
+
+def embed_chunk(texts: List[str]) -> List[Optional[List[float]]]:
     """
-    Get embedding for a single text using OpenAI API.
+    Embed one chunk of texts in a single API call, retrying transient
+    failures with exponential backoff.
+    
+    A chunk rejected for its input is split in halves until the rejected
+    texts are isolated: they get None, the rest are still embedded.
+    """
+    for attempt in range(EMBED_RETRIES):
+        try:
+            response = client.embeddings.create(
+                input=texts,
+                model=os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+            )
+            # Results carry the index of their input; keep input order
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == EMBED_RETRIES - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+            print(f"  Embedding chunk of {len(texts)} failed ({e}); retrying in {delay}s")
+            time.sleep(delay)
+        except INPUT_ERRORS as e:
+            if len(texts) == 1:
+                print(f"  Text rejected ({e}); skipping it")
+                return [None]
+            half = len(texts) // 2
+            return embed_chunk(texts[:half]) + embed_chunk(texts[half:])
+
+def get_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    Get embeddings for many texts using batched OpenAI API calls.
+    
+    Texts are split with chunk_texts() and the chunks embedded
+    concurrently. A text the API rejects, or a chunk that still fails
+    after its retries, leaves None for its texts instead of failing the
+    others.
     
     Args:
-        text: The text to embed
+        texts: The texts to embed
     
     Returns:
-        List of floats representing the embedding
+        One embedding (or None) per text, in input order
     """
-    text = text.replace("\n", " ")  # Clean newlines
-    response = client.embeddings.create(
-        input=[text],
-        model=os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
-    )
-    return response.data[0].embedding
+    texts = [text.replace("\n", " ") for text in texts]  # Clean newlines
+    chunks = chunk_texts(texts)
+    embeddings = [None] * len(texts)
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+        futures = [pool.submit(embed_chunk, [texts[i] for i in chunk]) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                for i, embedding in zip(chunk, future.result()):
+                    embeddings[i] = embedding
+            except Exception as e:
+                print(f"  Embedding texts {chunk[0] + 1}-{chunk[-1] + 1} failed: {e}")
+    return embeddings
 
 def cosine_similarity(a: List[float], b: List[float]) -> float:
     """
@@ -102,10 +177,9 @@ def calculate_similarity(request: SimilarityRequest):
     Calculate similarity between query and documents.
     
     Process:
-    1. Get embeddings for all documents
-    2. Get embedding for query
-    3. Calculate cosine similarity between query and each doc
-    4. Return top 3 most similar documents
+    1. Get embeddings for the query and all documents in batched calls
+    2. Calculate cosine similarity between query and each doc
+    3. Return top 3 most similar documents
     
     Args:
         request: SimilarityRequest with docs and query
@@ -114,21 +188,20 @@ def calculate_similarity(request: SimilarityRequest):
         SimilarityResponse with top 3 matching document contents
     """
     try:
-        # Step 1: Get embeddings for all documents
-        print(f"Processing {len(request.docs)} documents...")
-        doc_embeddings = []
-        for i, doc in enumerate(request.docs):
-            embedding = get_embedding(doc)
-            doc_embeddings.append(embedding)
-            print(f"  Document {i+1}/{len(request.docs)} embedded")
-        
-        # Step 2: Get embedding for query
-        print(f"Processing query: '{request.query[:50]}...'")
-        query_embedding = get_embedding(request.query)
+        # Step 1: Get embeddings for the query and all documents; the query
+        # travels in the first chunk
+        print(f"Processing query: '{request.query[:50]}...' and {len(request.docs)} documents...")
+        embeddings = get_embeddings([request.query] + request.docs)
+        query_embedding, doc_embeddings = embeddings[0], embeddings[1:]
+        if query_embedding is None:
+            raise RuntimeError("query could not be embedded")
+        print(f"  {sum(e is not None for e in doc_embeddings)}/{len(request.docs)} documents embedded")
         
-        # Step 3: Calculate similarities
+        # Step 2: Calculate similarities (documents that failed to embed are skipped)
         similarities = []
         for i, doc_embedding in enumerate(doc_embeddings):
+            if doc_embedding is None:
+                continue
             similarity = cosine_similarity(query_embedding, doc_embedding)
             similarities.append({
                 'index': i,
@@ -137,7 +210,7 @@ def calculate_similarity(request: SimilarityRequest):
             })
             print(f"  Document {i+1} similarity: {similarity:.4f}")
         
-        # Step 4: Sort by similarity (highest first) and get top 3
+        # Step 3: Sort by similarity (highest first) and get top 3
         similarities.sort(key=lambda x: x['similarity'], reverse=True)
         top_3 = similarities[:3]
         
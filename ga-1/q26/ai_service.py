@@ -1,10 +1,20 @@
 from openai import OpenAI
+import asyncio
 import os
 import time
 from dotenv import load_dotenv
 
+from clients import get_async_client, with_retries
+from config import LLM_MODEL, LLM_MAX_CONCURRENCY
+
 load_dotenv()
 
+def messages(text):
+    return [
+        {"role": "system", "content": "You are a helpful code review assistant."},
+        {"role": "user", "content": text}
+    ]
+
 class AIService:
     def __init__(self):
         self.client = OpenAI(
@@ -16,11 +26,8 @@ class AIService:
         """Calls GPT-4o-mini for code review analysis"""
         try:
             response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a helpful code review assistant."},
-                    {"role": "user", "content": text}
-                ],
+                model=LLM_MODEL,
+                messages=messages(text),
                 max_tokens=500
             )
             return response.choices[0].message.content.strip()
@@ -28,4 +35,43 @@ class AIService:
             print(f"LLM error: {e}")
             return f"Error: Could not process request. {str(e)}"
 
+class AsyncAIService:
+    """Async counterpart of AIService on the shared pooled client.
+
+    A semaphore caps concurrent upstream calls; waiting requests hold no
+    thread, so one worker can keep hundreds of misses outstanding.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def query(self, text: str):
+        """Calls GPT-4o-mini for code review analysis. Returns (answer,
+        total tokens billed), tokens None if the response reports no usage.
+        Errors propagate, so a failure is never mistaken for an answer
+        worth caching."""
+        async with self.semaphore:
+            response = await with_retries(lambda: get_async_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages(text),
+                max_tokens=500
+            ))
+        tokens = response.usage.total_tokens if response.usage else None
+        return response.choices[0].message.content.strip(), tokens
+
+    async def stream(self, text):
+        """Yields GPT-4o-mini output as it arrives. Only the initial request
+        is retried; errors after the first chunk propagate."""
+        async with self.semaphore:
+            response = await with_retries(lambda: get_async_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages(text),
+                max_tokens=500,
+                stream=True
+            ))
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
 ai_service = AIService()
+async_ai_service = AsyncAIService()
@@ -1,24 +1,140 @@
 import time
+import bisect
+import threading
 from config import AVG_TOKENS_PER_REQUEST, MODEL_COST_PER_1M_TOKENS
 
+HIT_TYPES = ("exact", "shared", "semantic", "coalesced")
+TIERS = HIT_TYPES + ("miss",)
+STAGES = ("normalize", "exact_lookup", "embed", "semantic_scan", "llm")
+
+# Log-spaced bucket upper bounds: 4 per power of two from 10 us to ~2 min,
+# so any recorded value is off by at most ~19% (HDR-style, fixed memory).
+BUCKET_BOUNDS_MS = [0.01 * 2 ** (i / 4) for i in range(96)]
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)  # last one is overflow
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.total += 1
+        self.sum += ms
+
+    def percentile(self, p):
+        if not self.total:
+            return 0
+        rank = p / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKET_BOUNDS_MS[min(i, len(BUCKET_BOUNDS_MS) - 1)]
+        return BUCKET_BOUNDS_MS[-1]
+
+    def summary(self):
+        return {
+            "count": self.total,
+            "mean": round(self.sum / self.total, 2) if self.total else 0,
+            "p50": round(self.percentile(50), 2),
+            "p90": round(self.percentile(90), 2),
+            "p99": round(self.percentile(99), 2),
+        }
+
+    def prometheus(self, name, labels):
+        """Cumulative histogram lines in Prometheus text format (seconds)."""
+        lines = []
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound / 1000:.6g}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.total}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum / 1000:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.total}')
+        return lines
+
 class Analytics:
     def __init__(self):
-        self.total_requests = 0
-        self.cache_hits = 0
-        self.cache_misses = 0
-        self.total_latency = 0.0
-        self.cached_tokens = 0
-
-    def record_hit(self, latency_ms, tokens_saved):
-        self.total_requests += 1
-        self.cache_hits += 1
-        self.total_latency += latency_ms
-        self.cached_tokens += tokens_saved
-
-    def record_miss(self, latency_ms):
-        self.total_requests += 1
-        self.cache_misses += 1
-        self.total_latency += latency_ms
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.total_requests = 0
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self.total_latency = 0.0
+            self.cached_tokens = 0
+            # "shared" hits came from the cross-worker tier, "coalesced"
+            # ones waited on an identical in-flight miss
+            self.hits_by_type = dict.fromkeys(HIT_TYPES, 0)
+            self.latency = {tier: LatencyHistogram() for tier in TIERS}
+            # Streamed requests only: time until the first chunk was sent
+            self.ttft = {tier: LatencyHistogram() for tier in TIERS}
+            self.stages = {stage: LatencyHistogram() for stage in STAGES}
+            self.partitions = {}
+            self.sweeps = LatencyHistogram()
+            self.swept_entries = 0
+            # Pre-filter: lookups it decided, embeddings it skipped, and
+            # skipped queries that turned out to have a semantic match
+            self.prefilter_checks = 0
+            self.prefilter_skips = 0
+            self.prefilter_false_negatives = 0
+
+    def _partition(self, name):
+        counts = self.partitions.get(name)
+        if counts is None:
+            counts = self.partitions[name] = {"requests": 0, "hits": 0, "misses": 0}
+        counts["requests"] += 1
+        return counts
+
+    def record_hit(self, latency_ms, tokens_saved, hit_type="exact", partition="default"):
+        with self.lock:
+            self._partition(partition)["hits"] += 1
+            self.total_requests += 1
+            self.cache_hits += 1
+            self.hits_by_type[hit_type] += 1
+            self.total_latency += latency_ms
+            self.cached_tokens += tokens_saved
+            self.latency[hit_type].record(latency_ms)
+
+    def record_miss(self, latency_ms, partition="default"):
+        with self.lock:
+            self._partition(partition)["misses"] += 1
+            self.total_requests += 1
+            self.cache_misses += 1
+            self.total_latency += latency_ms
+            self.latency["miss"].record(latency_ms)
+
+    def record_ttft(self, tier, latency_ms):
+        with self.lock:
+            self.ttft[tier].record(latency_ms)
+
+    def record_stage(self, stage, latency_ms):
+        with self.lock:
+            self.stages[stage].record(latency_ms)
+
+    def record_prefilter(self, skipped):
+        with self.lock:
+            self.prefilter_checks += 1
+            self.prefilter_skips += skipped
+
+    def record_prefilter_false_negative(self):
+        with self.lock:
+            self.prefilter_false_negatives += 1
+
+    def partition_report(self):
+        with self.lock:
+            return {
+                name: dict(counts, hitRate=round(counts["hits"] / counts["requests"], 2))
+                for name, counts in self.partitions.items()
+            }
+
+    def record_sweep(self, removed, latency_ms):
+        with self.lock:
+            self.swept_entries += removed
+            self.sweeps.record(latency_ms)
 
     def report(self):
         hit_rate = (
@@ -36,14 +152,67 @@ class Analytics:
         # Savings as percentage of total cost
         savings_percent = int((savings / total_cost) * 100) if total_cost > 0 else 0
 
+        with self.lock:
+            latency = {tier: h.summary() for tier, h in self.latency.items()}
+            ttft = {tier: h.summary() for tier, h in self.ttft.items()}
+            stages = {stage: h.summary() for stage, h in self.stages.items()}
+            sweep = dict(self.sweeps.summary(), removed=self.swept_entries)
+            prefilter = {
+                "checks": self.prefilter_checks,
+                "skipped": self.prefilter_skips,
+                "falseNegatives": self.prefilter_false_negatives,
+                "falseNegativeRate": round(
+                    self.prefilter_false_negatives / self.prefilter_skips, 4
+                ) if self.prefilter_skips else 0,
+            }
+
         return {
             "hitRate": round(hit_rate, 2),
             "totalRequests": self.total_requests,
             "cacheHits": self.cache_hits,
             "cacheMisses": self.cache_misses,
+            "hitTypes": dict(self.hits_by_type),
             "costSavings": round(savings, 2),
-            "savingsPercent": savings_percent
+            "savingsPercent": savings_percent,
+            "latency": latency,
+            "timeToFirstToken": ttft,
+            "stages": stages,
+            "sweep": sweep,
+            "prefilter": prefilter
         }
 
+    def prometheus(self):
+        lines = [
+            "# TYPE cache_requests_total counter",
+            f"cache_requests_total {self.total_requests}",
+            "# TYPE cache_hits_total counter",
+        ]
+        with self.lock:
+            lines += [f'cache_hits_total{{type="{t}"}} {n}' for t, n in self.hits_by_type.items()]
+            lines += [
+                "# TYPE cache_misses_total counter",
+                f"cache_misses_total {self.cache_misses}",
+                "# TYPE cache_request_duration_seconds histogram",
+            ]
+            for tier, h in self.latency.items():
+                lines += h.prometheus("cache_request_duration_seconds", f'tier="{tier}"')
+            lines.append("# TYPE cache_time_to_first_token_seconds histogram")
+            for tier, h in self.ttft.items():
+                lines += h.prometheus("cache_time_to_first_token_seconds", f'tier="{tier}"')
+            lines.append("# TYPE cache_stage_duration_seconds histogram")
+            for stage, h in self.stages.items():
+                lines += h.prometheus("cache_stage_duration_seconds", f'stage="{stage}"')
+            lines += ["# TYPE cache_swept_entries_total counter",
+                      f"cache_swept_entries_total {self.swept_entries}",
+                      "# TYPE cache_sweep_duration_seconds histogram"]
+            lines += self.sweeps.prometheus("cache_sweep_duration_seconds", 'job="sweeper"')
+            lines += ["# TYPE cache_prefilter_checks_total counter",
+                      f"cache_prefilter_checks_total {self.prefilter_checks}",
+                      "# TYPE cache_prefilter_skips_total counter",
+                      f"cache_prefilter_skips_total {self.prefilter_skips}",
+                      "# TYPE cache_prefilter_false_negatives_total counter",
+                      f"cache_prefilter_false_negatives_total {self.prefilter_false_negatives}"]
+        return "\n".join(lines) + "\n"
+
 
 analytics = Analytics()
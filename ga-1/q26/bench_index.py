@@ -0,0 +1,68 @@
+"""Exact vs IVF semantic index: latency and recall@1.
+
+Usage: python bench_index.py [--sizes 10000,100000,500000] [--dim 384]
+
+Vectors are drawn around random cluster centres so the IVF lists have
+structure to exploit. At dim=1536 the 500k case needs ~3 GB per index.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from index import ExactIndex, IVFFlatIndex
+
+def unit(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+def make_data(n, dim, rng, clusters=1000):
+    centres = unit(rng.standard_normal((clusters, dim))).astype(np.float32)
+    data = centres[rng.integers(0, clusters, n)]
+    data += 0.3 / np.sqrt(dim) * rng.standard_normal((n, dim)).astype(np.float32)
+    return unit(data).astype(np.float32)
+
+def time_queries(index, queries, now):
+    found = []
+    start = time.perf_counter()
+    for q in queries:
+        found.append(index.search(q, now)[0])
+    return (time.perf_counter() - start) / len(queries) * 1000, np.array(found)
+
+def run(n, dim, nlist, nprobes, n_queries, rng):
+    data = make_data(n, dim, rng)
+    picks = rng.integers(0, n, n_queries)
+    queries = unit(data[picks] + 0.1 / np.sqrt(dim) * rng.standard_normal((n_queries, dim))).astype(np.float32)
+    expires = time.time() + 3600
+
+    exact = ExactIndex(n)
+    for slot in range(n):
+        exact.add(slot, data[slot], expires)
+    exact_ms, truth = time_queries(exact, queries, time.time())
+    print(f"n={n:>7}  exact        {exact_ms:8.3f} ms/query  recall@1 1.000")
+    del exact
+
+    start = time.perf_counter()
+    ivf = IVFFlatIndex(n, nlist=nlist, train_size=min(n, nlist * 64))
+    for slot in range(n):
+        ivf.add(slot, data[slot], expires)
+    build_s = time.perf_counter() - start
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        ivf_ms, found = time_queries(ivf, queries, time.time())
+        recall = float(np.mean(found == truth))
+        print(f"n={n:>7}  ivf nprobe={nprobe:<3} {ivf_ms:6.3f} ms/query  recall@1 {recall:.3f}"
+              f"  (build {build_s:.1f}s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,500000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", default="4,16,64")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    for n in (int(s) for s in args.sizes.split(",")):
+        run(n, args.dim, min(args.nlist, n // 16), [int(p) for p in args.nprobe.split(",")],
+            args.queries, rng)
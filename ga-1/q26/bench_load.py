@@ -0,0 +1,220 @@
+"""Offline load test of the caching service.
+
+Usage: python bench_load.py [--requests 5000] [--concurrency 64] [--stream]
+
+Starts stub_upstream.py and the service (uvicorn main:app) as
+subprocesses, so no API token or network is needed, then replays a Zipf
+trace of queries against POST /. A share of the requests are paraphrases
+of their topic's canonical query, which the stub embeds close to it.
+
+Reports throughput, client-side latency percentiles per hit tier (from
+each response's cached/cacheKey), hit rate, and the service's resident
+memory before, during and after the run. With --stream, requests use SSE
+and time to first chunk is reported too. --url drives a service that is
+already running instead (memory is then not sampled).
+
+The driver, the stub and the service each want a core of their own; on
+fewer cores the numbers mostly measure CPU contention between them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+from analytics import LatencyHistogram, TIERS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATES = [
+    "how do i {0} the {1} {2}",
+    "what is the best way to {0} {1} {2}",
+    "{0} {1} {2}",
+    "explain how to {0} a {1} {2}",
+    "how can i {0} my {1} {2}?",
+    "please tell me how to {0} the {1} {2}",
+]
+
+def topic_words(topic, vocab=5000):
+    ids = np.random.default_rng(topic).choice(vocab, 3, replace=False)
+    return [f"w{i}" for i in ids]
+
+def make_trace(n, topics, zipf_s, paraphrase, rng):
+    """Queries for n requests: Zipf-distributed topics, each asked in its
+    canonical form or, with probability paraphrase, a reworded one."""
+    ranks = (rng.zipf(zipf_s, n) - 1) % topics
+    trace = []
+    for topic, reword in zip(ranks, rng.random(n) < paraphrase):
+        template = TEMPLATES[rng.integers(1, len(TEMPLATES))] if reword else TEMPLATES[0]
+        trace.append(template.format(*topic_words(int(topic))))
+    return trace
+
+def tier_of(result):
+    if not result["cached"]:
+        return "miss"
+    prefix = result["cacheKey"].split("_", 1)[0]
+    return prefix if prefix in TIERS else "exact"
+
+def rss_mib(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+async def sample_memory(pid, samples, interval=0.25):
+    while True:
+        rss = rss_mib(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+async def send(client, query, stream):
+    """POST one query; returns (result, seconds to first chunk or None)."""
+    body = {"query": query, "application": "load test", "stream": stream}
+    if not stream:
+        r = await client.post("/", json=body)
+        return r.json(), None
+    start = time.perf_counter()
+    first = None
+    async with client.stream("POST", "/", json=body) as r:
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if first is None:
+                first = time.perf_counter() - start
+            event = json.loads(line[6:])
+    return event, first
+
+async def drive(url, trace, concurrency, stream, pid=None):
+    latency = {tier: LatencyHistogram() for tier in TIERS}
+    ttft = {tier: LatencyHistogram() for tier in TIERS}
+    errors = 0
+    samples = []
+    sampler = asyncio.create_task(sample_memory(pid, samples)) if pid else None
+    queries = iter(trace)
+
+    async def worker(client):
+        nonlocal errors
+        for query in queries:
+            start = time.perf_counter()
+            try:
+                result, first = await send(client, query, stream)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            tier = tier_of(result)
+            latency[tier].record((time.perf_counter() - start) * 1000)
+            if first is not None:
+                ttft[tier].record(first * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        server = (await client.get("/analytics")).json()
+    if sampler:
+        await asyncio.sleep(0.3)  # one sample after the run
+        sampler.cancel()
+    return latency, ttft, errors, elapsed, samples, server
+
+def wait_ready(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+def start_servers(args):
+    stub = subprocess.Popen(
+        [sys.executable, "stub_upstream.py", "--port", str(args.stub_port),
+         "--chat-latency-ms", str(args.chat_latency_ms),
+         "--embed-latency-ms", str(args.embed_latency_ms)],
+        cwd=HERE
+    )
+    env = dict(os.environ, AIPIPE_TOKEN="stub",
+               AIPIPE_BASE_URL=f"http://127.0.0.1:{args.stub_port}/v1")
+    for name in ("CACHE_SNAPSHOT_DIR", "SHARED_CACHE_PATH", "EMBED_CACHE_PATH"):
+        env.pop(name, None)  # start cold, with nothing shared
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port),
+         "--log-level", "warning"],
+        cwd=HERE, env=env
+    )
+    wait_ready(f"http://127.0.0.1:{args.stub_port}/stats", stub)
+    wait_ready(f"http://127.0.0.1:{args.port}/analytics", service)
+    return stub, service
+
+def report(args, latency, ttft, errors, elapsed, samples, server, upstream):
+    done = sum(h.total for h in latency.values())
+    hits = done - latency["miss"].total
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {args.topics} topics, "
+          f"zipf s={args.zipf}, {args.paraphrase:.0%} paraphrased"
+          + (", streamed" if args.stream else ""))
+    print(f"throughput  {done / elapsed:.1f} req/s ({elapsed:.1f}s, {errors} errors)")
+    print(f"hitRate     {hits / max(done, 1):.3f}  "
+          + "  ".join(f"{t} {latency[t].total / max(done, 1):.3f}" for t in TIERS))
+    print(f"{'tier':10} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9}  (ms, client side)")
+    for tier in TIERS:
+        s = latency[tier].summary()
+        print(f"{tier:10} {s['count']:7} {s['p50']:9.2f} {s['p90']:9.2f} {s['p99']:9.2f}")
+    if args.stream:
+        print("time to first chunk")
+        for tier in TIERS:
+            s = ttft[tier].summary()
+            print(f"{tier:10} {s['count']:7} {s['p50']:9.2f} {s['p90']:9.2f} {s['p99']:9.2f}")
+    if samples:
+        print(f"memory      RSS {samples[0]:.1f} -> {samples[-1]:.1f} MiB "
+              f"(peak {max(samples):.1f}, +{samples[-1] - samples[0]:.1f} MiB)")
+    print(f"server      hitRate {server['hitRate']}  cacheSize {server['cacheSize']}  "
+          f"prefilter {server.get('prefilter')}")
+    if upstream:
+        print(f"upstream    {upstream}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--topics", type=int, default=1000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--paraphrase", type=float, default=0.3)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--chat-latency-ms", type=float, default=400)
+    parser.add_argument("--embed-latency-ms", type=float, default=40)
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--url", help="drive this running service instead of starting one")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    trace = make_trace(args.requests, args.topics, args.zipf, args.paraphrase,
+                       np.random.default_rng(args.seed))
+    stub = service = None
+    url = args.url
+    if not url:
+        stub, service = start_servers(args)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        results = asyncio.run(drive(url, trace, args.concurrency, args.stream,
+                                    service.pid if service else None))
+        upstream = httpx.get(f"http://127.0.0.1:{args.stub_port}/stats").json() if stub else None
+        report(args, *results, upstream)
+    finally:
+        for proc in (service, stub):
+            if proc:
+                proc.terminate()
+                proc.wait()
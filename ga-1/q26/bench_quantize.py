@@ -0,0 +1,72 @@
+"""Memory and hit-rate drift of quantized embedding storage.
+
+Usage: python bench_quantize.py [--requests 10000] [--capacity 5000]
+
+Replays a Zipf trace of paraphrased queries through the semantic path
+(get_semantic, then set_with_embedding on a miss) once per storage mode.
+Each query is its intent's vector plus noise, so paraphrases land on both
+sides of the similarity threshold. Results are compared with float32:
+drift is the share of requests whose answer (or miss) changed.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from cache import Cache
+
+MODES = [
+    ("float32", False),
+    ("float16", False),
+    ("float16", True),
+    ("int8", False),
+    ("int8", True),
+]
+
+def make_trace(n, universe, dim, noise, zipf_s, rng):
+    intents = rng.standard_normal((universe, dim)).astype(np.float32)
+    intents /= np.linalg.norm(intents, axis=1, keepdims=True)
+    ids = (rng.zipf(zipf_s, n) - 1) % universe
+    # Per-query noise level, so pair similarities spread around the threshold
+    level = noise * rng.uniform(0.5, 1.5, (n, 1)).astype(np.float32)
+    vecs = intents[ids] + rng.standard_normal((n, dim)).astype(np.float32) * level / np.sqrt(dim)
+    return ids, vecs
+
+def replay(storage, rescore, ids, vecs, capacity, threshold):
+    c = Cache(max_size=capacity, threshold=threshold, storage=storage, rescore=rescore)
+    answers = []
+    start = time.perf_counter()
+    for i, (intent, vec) in enumerate(zip(ids, vecs)):
+        answer = c.get_semantic(vec)
+        if answer is None:
+            c.set_with_embedding(f"query {i}", f"answer {intent}", vec)
+        answers.append(answer)
+    elapsed = time.perf_counter() - start
+    return answers, c.index.nbytes(), elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--capacity", type=int, default=5000)
+    parser.add_argument("--universe", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--noise", type=float, default=0.2)
+    parser.add_argument("--threshold", type=float, default=0.95)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(11)
+    ids, vecs = make_trace(args.requests, args.universe, args.dim, args.noise, args.zipf, rng)
+
+    print(f"{args.requests} requests, capacity {args.capacity}, dim {args.dim}, "
+          f"threshold {args.threshold}")
+    baseline = None
+    for storage, rescore in MODES:
+        answers, nbytes, elapsed = replay(storage, rescore, ids, vecs, args.capacity, args.threshold)
+        if baseline is None:
+            baseline = answers
+        hits = sum(a is not None for a in answers)
+        drift = sum(a != b for a, b in zip(answers, baseline))
+        label = storage + (" +rescore" if rescore else "")
+        print(f"{label:17} {nbytes / 2**20:7.1f} MiB  hitRate {hits / len(answers):.4f}  "
+              f"drift {drift / len(answers):.4%}  {elapsed / len(answers) * 1e6:6.0f} us/request")
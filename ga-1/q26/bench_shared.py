@@ -0,0 +1,104 @@
+"""Hit rate across several workers, with and without the shared tier.
+
+Usage: python bench_shared.py [--workers 4] [--requests 40000]
+                              [--capacity 1500] [--shared-size 20000]
+
+A Zipf query trace is dealt round-robin to worker processes, the way a
+load balancer spreads requests over uvicorn workers. Each worker runs
+the same exact-match lookup path as POST / against its own L1 cache of
+--capacity entries and, when enabled, a SharedTier in a temporary SQLite
+file. The shared tier is run twice: at --capacity entries, so any gain
+over L1 only comes from sharing, and at --shared-size (SHARED_MAX_SIZE),
+which adds the extra capacity a deployment gets on top.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from cache import PartitionedCache
+from config import SHARED_MAX_SIZE
+from shared import SharedTier
+
+PARTITION = "bench"
+SYNC_EVERY = 200
+
+def vector(qid, dim=16):
+    return np.random.default_rng(int(qid)).standard_normal(dim)
+
+def worker(trace, capacity, path, shared_size, results):
+    # threshold > 1 disables semantic matches: only exact reuse is counted
+    cache = PartitionedCache(settings={PARTITION: {"max_size": capacity, "threshold": 2.0}})
+    tier = SharedTier(path, shared_size) if path else None
+    part = cache.partition(PARTITION)
+    hits = 0
+    for i, qid in enumerate(trace):
+        query = f"query {qid}"
+        key = cache._hash(query)
+        if part.get_exact(query) is not None:
+            hits += 1
+        elif tier and (row := tier.get(PARTITION, key)):
+            answer, vec, created, cost, sig = row
+            part.insert(key, answer, vec, created, cost, sig)
+            hits += 1
+        else:
+            answer = f"answer {qid}"
+            sig = part.sketch(query)
+            entry = part.set_with_embedding(query, answer, vector(qid), sig=sig)
+            if tier:
+                tier.put(PARTITION, key, answer, part._as_unit(vector(qid)),
+                         entry.timestamp, entry.timestamp + part.ttl, entry.cost, sig)
+        if tier and i % SYNC_EVERY == 0:
+            tier.sync_into(cache)
+    results.put((hits, len(trace)))
+
+def run(trace, workers, capacity, shared_size=0):
+    path = None
+    if shared_size:
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        SharedTier(path, shared_size)  # create the schema once
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=worker, args=(trace[w::workers], capacity, path, shared_size, results))
+        for w in range(workers)
+    ]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    totals = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+    if path:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    hits = sum(h for h, _ in totals)
+    return hits / len(trace), elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40000)
+    parser.add_argument("--capacity", type=int, default=1500)
+    parser.add_argument("--shared-size", type=int, default=SHARED_MAX_SIZE)
+    parser.add_argument("--universe", type=int, default=20000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(3)
+    trace = (rng.zipf(args.zipf, args.requests) - 1) % args.universe
+
+    for label, workers, shared_size in [
+        ("1 worker, L1 only", 1, 0),
+        (f"{args.workers} workers, L1 only", args.workers, 0),
+        # Same capacity as each L1: the gain is sharing alone
+        (f"{args.workers} workers, + shared {args.capacity}", args.workers, args.capacity),
+        (f"{args.workers} workers, + shared {args.shared_size}", args.workers, args.shared_size),
+    ]:
+        hit_rate, elapsed = run(trace, workers, args.capacity, shared_size)
+        print(f"{label:32} hitRate {hit_rate:.3f}  ({elapsed:.1f}s)")
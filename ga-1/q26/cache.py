@@ -1,19 +1,65 @@
 import time
+import heapq
+import asyncio
 import hashlib
+import threading
 from collections import OrderedDict
 
-from config import CACHE_MAX_SIZE, CACHE_TTL_SECONDS, EMBEDDING_SIM_THRESHOLD
-from embeddings import embed, similarity
+import numpy as np
+
+from config import (
+    CACHE_MAX_SIZE, CACHE_TTL_SECONDS, EMBEDDING_SIM_THRESHOLD, CACHE_INDEX,
+    SWEEP_BATCH_SIZE, CACHE_PARTITIONS, CACHE_MAX_PARTITIONS, CACHE_POLICY,
+    EMBEDDING_STORAGE, EMBEDDING_RESCORE, PREFILTER
+)
+from embeddings import embed
+from index import make_index
+from policy import make_policy, estimate_tokens
+from prefilter import MinHashFilter
 
 class CacheEntry:
-    def __init__(self, answer, embedding):
+    def __init__(self, answer, slot, timestamp=None, cost=None):
         self.answer = answer
-        self.embedding = embedding
-        self.timestamp = time.time()
+        self.slot = slot
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.cost = estimate_tokens(answer) if cost is None else cost
+
+    def answer_size(self):
+        return len(self.answer)
 
 class Cache:
-    def __init__(self):
+    def __init__(self, max_size=CACHE_MAX_SIZE, index=CACHE_INDEX,
+                 ttl=CACHE_TTL_SECONDS, threshold=EMBEDDING_SIM_THRESHOLD,
+                 policy=CACHE_POLICY, storage=EMBEDDING_STORAGE,
+                 rescore=EMBEDDING_RESCORE, prefilter=PREFILTER):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
         self.store = OrderedDict()
+        self.lock = threading.RLock()
+        # Embeddings live in the index, addressed by slot; _keys maps a
+        # slot back to its store key so a match can be promoted in the LRU.
+        self.index = make_index(index, max_size, storage, rescore, self.lock)
+        # Decides which entry to evict (and so, for TinyLFU, what to admit)
+        self.policy = make_policy(policy, max_size)
+        # Lexical sketch of each cached query, so obvious misses skip embedding
+        self.prefilter = MinHashFilter(max_size) if prefilter else None
+        self._keys = [None] * max_size
+        self._free = list(range(max_size - 1, -1, -1))
+        # Slots a snapshot restore has claimed but not yet filled, newest
+        # entry first. They count toward capacity; when no slot is free an
+        # insert takes the oldest one and that entry is never restored.
+        self._reserved = {}
+        # Bumped by clear() so a background snapshot restore can tell that
+        # the cache it was filling has been wiped underneath it.
+        self.generation = 0
+        # Slots written while a snapshot copies the index (None otherwise)
+        self.written = None
+        # Min-heap of (expires_at, seq, key, entry). Stale items (the key was
+        # evicted or rewritten since) are skipped when they surface.
+        self._expiry = []
+        self._seq = 0
+        self.expired = 0
 
     def _hash(self, text: str):
         return hashlib.md5(text.encode()).hexdigest()
@@ -21,43 +67,272 @@ class Cache:
     def normalize(self, text: str):
         return text.strip().lower()
 
+    def _as_unit(self, embedding):
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _entry_size(self, entry):
+        # Answer bytes plus the (possibly quantized) embedding row
+        return entry.answer_size() + self.index.row_bytes()
+
+    def _remove(self, key):
+        entry = self.store.pop(key)
+        self.policy.on_remove(key)
+        self.index.remove(entry.slot)
+        if self.prefilter:
+            self.prefilter.remove(entry.slot)
+        self._keys[entry.slot] = None
+        self._free.append(entry.slot)
+
+    def _track_expiry(self, key, entry):
+        self._seq += 1
+        heapq.heappush(self._expiry, (entry.timestamp + self.ttl, self._seq, key, entry))
+        # Keep stale heap items from piling up under heavy rewriting
+        if len(self._expiry) > 2 * self.max_size + 1024:
+            self._expiry = [item for item in self._expiry if self.store.get(item[2]) is item[3]]
+            heapq.heapify(self._expiry)
+
+    def sweep(self, max_batch=SWEEP_BATCH_SIZE):
+        """Remove up to max_batch expired entries; returns how many went."""
+        removed = 0
+        now = time.time()
+        with self.lock:
+            while self._expiry and removed < max_batch and self._expiry[0][0] <= now:
+                _, _, key, entry = heapq.heappop(self._expiry)
+                if self.store.get(key) is entry:
+                    self._remove(key)
+                    removed += 1
+            self.expired += removed
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+            self.index.clear()
+            self.policy.clear()
+            if self.prefilter:
+                self.prefilter.clear()
+            self._expiry = []
+            self._keys = [None] * self.max_size
+            self._free = list(range(self.max_size - 1, -1, -1))
+            self._reserved = {}
+            self.generation += 1
+
+    def begin_restore(self, matrix, slots, scales=None, full=None, sigs=None):
+        """Empty the cache, adopt a snapshot matrix and reserve its slots."""
+        reserved = dict.fromkeys(slots.tolist())
+        free = np.setdiff1d(np.arange(self.max_size), slots)[::-1].tolist()
+        with self.lock:
+            self.clear()
+            self.index.attach(matrix, scales, full)
+            if self.prefilter:
+                self.prefilter.attach(sigs)
+            self._reserved = reserved
+            self._free = free
+            return self.generation
+
+    def restore(self, generation, keys, entries, bands=None):
+        """Insert snapshot entries, newest first, behind everything cached.
+        bands are the entries' pre-filter band keys, from bands_of(), so
+        that the work done under the lock stays small."""
+        if bands is None:
+            bands = [None] * len(entries)
+        with self.lock:
+            if generation != self.generation:
+                return False
+
+            slots, expires, filed = [], [], []
+            for key, entry, keys_of_bands in zip(keys, entries, bands):
+                if entry.slot not in self._reserved:
+                    # An insert already took this slot over
+                    continue
+                del self._reserved[entry.slot]
+                if key in self.store:
+                    self._free.append(entry.slot)
+                    continue
+                self.store[key] = entry
+                self.store.move_to_end(key, last=False)
+                self._keys[entry.slot] = key
+                self._track_expiry(key, entry)
+                self.policy.on_restore(key, entry.cost, self._entry_size(entry))
+                slots.append(entry.slot)
+                expires.append(entry.timestamp + self.ttl)
+                filed.append(keys_of_bands)
+            self.index.restore(np.array(slots, dtype=np.int64), np.array(expires))
+            if self.prefilter:
+                self.prefilter.restore(slots, filed)
+            return True
+
     def get_exact(self, query):
         key = self._hash(query)
-        entry = self.store.get(key)
+        with self.lock:
+            self.policy.record(key)
+            entry = self.store.get(key)
 
-        if not entry:
-            return None
+            if not entry:
+                return None
+
+            if time.time() - entry.timestamp > self.ttl:
+                self._remove(key)
+                self.expired += 1
+                return None
+
+            self.store.move_to_end(key)
+            self.policy.on_hit(key)
+            return entry.answer
+
+    def sketch(self, query):
+        """Pre-filter signature of a normalized query (None if disabled)."""
+        return self.prefilter.signature(query) if self.prefilter else None
 
-        if time.time() - entry.timestamp > CACHE_TTL_SECONDS:
-            del self.store[key]
+    def may_match(self, sig):
+        """False when the pre-filter rules out any semantic neighbour."""
+        with self.lock:
+            return self.prefilter is None or sig is None or self.prefilter.may_match(sig)
+
+    def _match(self, q):
+        if not self.store:
+            return None
+        slot, sim = self.index.search(q, time.time())
+        if slot < 0 or sim < self.threshold:
             return None
+        return self._keys[slot]
 
-        self.store.move_to_end(key)
-        return entry.answer
+    def has_semantic(self, query_embedding):
+        """Whether get_semantic would hit, without touching recency."""
+        q = self._as_unit(query_embedding)
+        with self.lock:
+            return self._match(q) is not None
 
     def get_semantic(self, query_embedding):
-        for key, entry in self.store.items():
-            if time.time() - entry.timestamp > CACHE_TTL_SECONDS:
-                continue
+        q = self._as_unit(query_embedding)
+        with self.lock:
+            key = self._match(q)
+            if key is None:
+                return None
 
-            sim = similarity(query_embedding, entry.embedding)
-            if sim >= EMBEDDING_SIM_THRESHOLD:
-                self.store.move_to_end(key)
-                return entry.answer
-
-        return None
+            self.store.move_to_end(key)
+            self.policy.record(key)
+            self.policy.on_hit(key)
+            return self.store[key].answer
 
     def set(self, query, answer):
         emb = embed(query)
         self.set_with_embedding(query, answer, emb)
 
-    def set_with_embedding(self, query, answer, embedding):
-        if len(self.store) >= CACHE_MAX_SIZE:
-            # Evict the oldest item (LRU)
-            self.store.popitem(last=False)
+    def set_with_embedding(self, query, answer, embedding, cost=None, sig=None):
+        """Cache answer; cost is its token cost (estimated if not given)."""
+        if sig is None:
+            sig = self.sketch(query)
+        return self.insert(self._hash(query), answer, embedding, cost=cost, sig=sig)
 
-        key = self._hash(query)
-        self.store[key] = CacheEntry(answer, embedding)
-        self.store.move_to_end(key)
+    def insert(self, key, answer, embedding, timestamp=None, cost=None, sig=None):
+        """Store under an already-hashed key. A timestamp from another tier
+        keeps the entry's original expiry instead of restarting its TTL.
+        Without a pre-filter signature the filter cannot rule anything out
+        while the entry lives."""
+        vec = self._as_unit(embedding)
+        with self.lock:
+            if key in self.store:
+                self._remove(key)
+            elif len(self.store) >= self.max_size:
+                # Evict the policy's victim and reuse its slot
+                self._remove(self.policy.victim())
+
+            if self._free:
+                slot = self._free.pop()
+            else:
+                # Everything else is reserved by a restore still in progress
+                slot = self._reserved.popitem()[0]
+            if self.written is not None:
+                self.written.add(slot)
+            entry = CacheEntry(answer, slot, timestamp, cost)
+            self.index.add(slot, vec, entry.timestamp + self.ttl)
+            if self.prefilter:
+                self.prefilter.add(slot, sig)
+            self._keys[slot] = key
+            self.store[key] = entry
+            self.store.move_to_end(key)
+            self._track_expiry(key, entry)
+            self.policy.on_insert(key, entry.cost, self._entry_size(entry))
+            return entry
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.store:
+                self._remove(key)
+
+class PartitionedCache:
+    """One Cache per application, each with its own capacity, TTL,
+    similarity threshold and embedding index.
+
+    Settings come from CACHE_PARTITIONS, falling back to the global
+    defaults. Past CACHE_MAX_PARTITIONS, unconfigured applications share
+    the "default" partition so tenant count cannot grow memory unbounded.
+    """
+
+    def __init__(self, settings=CACHE_PARTITIONS, max_partitions=CACHE_MAX_PARTITIONS):
+        self.settings = settings
+        self.max_partitions = max_partitions
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def _hash(self, text: str):
+        return hashlib.md5(text.encode()).hexdigest()
+
+    def normalize(self, text: str):
+        return text.strip().lower()
+
+    def partition_name(self, application):
+        name = self.normalize(application) or "default"
+        if (name in self.partitions or name in self.settings
+                or len(self.partitions) < self.max_partitions):
+            return name
+        return "default"
+
+    def partition(self, application):
+        name = self.partition_name(application)
+        part = self.partitions.get(name)
+        if part is None:
+            with self.lock:
+                part = self.partitions.get(name)
+                if part is None:
+                    part = self.partitions[name] = Cache(**self.settings.get(name, {}))
+        return part
+
+    def items(self):
+        return list(self.partitions.items())
+
+    def size(self):
+        return sum(len(p.store) for _, p in self.items())
+
+    @property
+    def expired(self):
+        return sum(p.expired for _, p in self.items())
+
+    def clear(self):
+        with self.lock:
+            for part in self.partitions.values():
+                part.clear()
+            self.partitions = {}
+
+    def sweep(self, max_batch=SWEEP_BATCH_SIZE):
+        return sum(p.sweep(max_batch) for _, p in self.items())
+
+async def run_sweeper(cache, interval, on_sweep=None):
+    """Every interval seconds, sweep expired entries in bounded batches off
+    the event loop, so the lock is never held for one huge pass."""
+    while True:
+        await asyncio.sleep(interval)
+        start = time.perf_counter()
+        removed = 0
+        while True:
+            batch = await asyncio.to_thread(cache.sweep)
+            removed += batch
+            if batch == 0:
+                break
+        if on_sweep:
+            on_sweep(removed, (time.perf_counter() - start) * 1000)
 
-cache = Cache()
+cache = PartitionedCache()
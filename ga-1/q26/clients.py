@@ -0,0 +1,59 @@
+import asyncio
+import os
+import random
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+from config import (
+    HTTP_MAX_CONNECTIONS, UPSTREAM_TIMEOUT_SECONDS,
+    UPSTREAM_MAX_RETRIES, UPSTREAM_RETRY_BASE_SECONDS
+)
+
+load_dotenv()
+
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# One pooled client shared by the LLM and embedding calls
+_async_client = None
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            api_key=os.getenv('AIPIPE_TOKEN') or os.getenv('AIPROXY_TOKEN'),
+            base_url=os.getenv('AIPIPE_BASE_URL') or "https://aipipe.org/openai/v1",
+            timeout=UPSTREAM_TIMEOUT_SECONDS,
+            max_retries=0,  # retried below, with jitter
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS
+                ),
+                timeout=UPSTREAM_TIMEOUT_SECONDS
+            )
+        )
+    return _async_client
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+async def with_retries(call):
+    """Awaits call(), retrying transient upstream errors with full-jitter
+    exponential backoff."""
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        try:
+            return await call()
+        except RETRYABLE_ERRORS:
+            if attempt == UPSTREAM_MAX_RETRIES:
+                raise
+            await asyncio.sleep(random.uniform(0, UPSTREAM_RETRY_BASE_SECONDS * 2 ** attempt))
@@ -1,7 +1,69 @@
+import os
+
 CACHE_MAX_SIZE = 1500
 CACHE_TTL_SECONDS = 86400  # 24 hours
+SWEEP_INTERVAL_SECONDS = 30  # background removal of expired entries
+SWEEP_BATCH_SIZE = 1000  # entries removed per lock acquisition
 
 EMBEDDING_SIM_THRESHOLD = 0.95
+# Eviction policy: "lru", "tinylfu" (frequency-filtered admission) or
+# "gds" (GreedyDual-Size, keeps answers that cost more tokens to produce)
+CACHE_POLICY = "lru"
+
+# Each QueryRequest.application gets its own cache partition. Override
+# max_size / ttl / threshold / index / policy / storage / rescore / prefilter
+# per application here; others use the
+# defaults above.
+CACHE_PARTITIONS = {
+    # "code review assistant": {"max_size": 5000, "ttl": 3600, "threshold": 0.97},
+}
+CACHE_MAX_PARTITIONS = 32  # further unconfigured applications share "default"
+# Semantic index backend: "exact" (brute force) or "ivf" (approximate).
+CACHE_INDEX = "exact"
+# IVF lists probed per lookup; higher = better recall, slower lookups
+EMBEDDING_SEARCH_NPROBE = 16
+IVF_NLIST = 256
+IVF_TRAIN_SIZE = 10000  # live entries needed before the IVF index is trained
+# Embedding row format: "float32", "float16" (1/2 the memory, scans a few
+# times slower than float32) or "int8" (~1/4, per-row scale, about as fast
+# as float32). EMBEDDING_RESCORE re-checks the best EMBEDDING_RESCORE_K
+# quantized candidates against disk-backed float32 copies.
+EMBEDDING_STORAGE = "float32"
+EMBEDDING_RESCORE = True
+EMBEDDING_RESCORE_K = 8
+# MinHash LSH pre-filter: exact misses sharing no band with any cached
+# query skip the embedding call and go straight to the LLM. More rows per
+# band filter more aggressively (and miss more paraphrases).
+PREFILTER = True
+PREFILTER_BANDS = 16
+PREFILTER_ROWS = 2
+PREFILTER_NGRAM = 3  # characters per shingle
+
+# Upstream (LLM + embeddings) HTTP client
+LLM_MODEL = "gpt-4o-mini"
+LLM_MAX_CONCURRENCY = 256  # outstanding LLM calls per worker process
+EMBED_MAX_CONCURRENCY = 256
+HTTP_MAX_CONNECTIONS = 256
+UPSTREAM_TIMEOUT_SECONDS = 30
+UPSTREAM_MAX_RETRIES = 3
+UPSTREAM_RETRY_BASE_SECONDS = 0.25
+STREAM_REPLAY_CHUNK_CHARS = 64  # characters per event when a hit is streamed
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBED_CACHE_SIZE = 20000  # memoized embeddings kept in memory
+# Optional file the embedding memo is loaded from and saved to
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH")
+
+# Opt-in warm restarts: set CACHE_SNAPSHOT_DIR to persist the cache there
+SNAPSHOT_DIR = os.getenv("CACHE_SNAPSHOT_DIR")
+SNAPSHOT_INTERVAL_SECONDS = 300
+
+# Opt-in shared tier for several workers/replicas on one host: set
+# SHARED_CACHE_PATH to a SQLite file every worker can open
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH")
+SHARED_MAX_SIZE = 20000  # entries per partition; keep >= the partition's max_size
+SHARED_SYNC_INTERVAL_SECONDS = 1
+SHARED_SYNC_BATCH = 2000
 
 MODEL_COST_PER_1M_TOKENS = 1.20
 AVG_TOKENS_PER_REQUEST = 2000
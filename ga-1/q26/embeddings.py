@@ -1,9 +1,16 @@
+import asyncio
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 from openai import OpenAI
 import os
+import hashlib
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 
+from clients import get_async_client, with_retries
+from config import EMBEDDING_MODEL, EMBED_CACHE_SIZE, EMBED_MAX_CONCURRENCY
+
 load_dotenv()
 
 # Initialize client here or pass it from main.py
@@ -18,21 +25,145 @@ def get_client():
         )
     return _client
 
-def embed(text: str) -> np.ndarray:
-    """Gets real embedding from OpenAI"""
+class EmbeddingCache:
+    """Bounded LRU of embeddings keyed by a hash of (model, text)."""
+
+    def __init__(self, max_size=EMBED_CACHE_SIZE):
+        self.max_size = max_size
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, model=EMBEDDING_MODEL):
+        return hashlib.sha1(f"{model}\0{text}".encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            vec = self.store.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store.move_to_end(key)
+            return vec
+
+    def put(self, key, vec):
+        with self.lock:
+            self.store[key] = np.asarray(vec, dtype=np.float32).reshape(-1)
+            self.store.move_to_end(key)
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.store),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 2) if lookups else 0
+        }
+
+    def save(self, path):
+        with self.lock:
+            keys = np.array(list(self.store), dtype="S40")
+            vecs = np.stack(list(self.store.values())) if self.store else np.zeros((0, 0), np.float32)
+        with open(path, "wb") as f:
+            np.savez(f, keys=keys, vecs=vecs)
+
+    def load(self, path):
+        try:
+            data = np.load(path)
+        except (OSError, ValueError):
+            return 0
+        for key, vec in zip(data["keys"], data["vecs"]):
+            self.put(key.decode(), vec)
+        return len(data["keys"])
+
+embed_cache = EmbeddingCache()
+
+def _fallback(text):
+    # Fallback to random if API fails, though not ideal
+    np.random.seed(abs(hash(text)) % (10**8))
+    return np.random.randn(1536)
+
+def _pending(texts):
+    """Looks texts up in the memo. Returns their keys, the memoized vectors
+    (None where missing) and {key: text} for the ones to fetch."""
+    keys = [embed_cache.key(t) for t in texts]
+    vecs = [embed_cache.get(k) for k in keys]
+
+    pending = {}
+    for text, key, vec in zip(texts, keys, vecs):
+        if vec is None:
+            pending.setdefault(key, text)
+    return keys, vecs, pending
+
+def _store(pending, response):
+    fetched = {}
+    for key, item in zip(pending, response.data):
+        fetched[key] = np.array(item.embedding, dtype=np.float32)
+        embed_cache.put(key, fetched[key])
+    return fetched
+
+def _merge(keys, vecs, fetched):
+    return np.vstack([fetched[k] if v is None else v for k, v in zip(keys, vecs)])
+
+def embed_many(texts) -> np.ndarray:
+    """Embeds a list of texts as an (n, dim) array.
+
+    Memoized texts are served locally; the rest go upstream in one request.
+    """
+    keys, vecs, pending = _pending(texts)
+    if not pending:
+        return np.vstack(vecs)
+
     try:
         client = get_client()
         response = client.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
+            input=list(pending.values()),
+            model=EMBEDDING_MODEL
         )
-        # Convert to numpy array and reshape to (1, -1)
-        return np.array(response.data[0].embedding).reshape(1, -1)
+        fetched = _store(pending, response)
     except Exception as e:
         print(f"Embedding error: {e}")
-        # Fallback to random if API fails, though not ideal
-        np.random.seed(abs(hash(text)) % (10**8))
-        return np.random.randn(1, 1536)
+        # Fallback vectors are not memoized so a later call can retry
+        fetched = {key: _fallback(text) for key, text in pending.items()}
+    return _merge(keys, vecs, fetched)
+
+_embed_semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+async def aembed_many(texts) -> np.ndarray:
+    """Async embed_many on the shared pooled client, with retries."""
+    keys, vecs, pending = _pending(texts)
+    if not pending:
+        return np.vstack(vecs)
+
+    try:
+        async with _embed_semaphore:
+            response = await with_retries(lambda: get_async_client().embeddings.create(
+                input=list(pending.values()),
+                model=EMBEDDING_MODEL
+            ))
+        fetched = _store(pending, response)
+    except Exception as e:
+        print(f"Embedding error: {e}")
+        fetched = {key: _fallback(text) for key, text in pending.items()}
+    return _merge(keys, vecs, fetched)
+
+def embed(text: str) -> np.ndarray:
+    """Gets real embedding from OpenAI"""
+    # Shape (1, -1) like a single-row batch
+    return embed_many([text])
+
+async def aembed(text: str) -> np.ndarray:
+    return await aembed_many([text])
 
 def similarity(vec1, vec2):
     return cosine_similarity(vec1, vec2)[0][0]
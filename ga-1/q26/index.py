@@ -0,0 +1,400 @@
+import tempfile
+import threading
+
+import numpy as np
+
+from config import (
+    IVF_NLIST, IVF_TRAIN_SIZE, EMBEDDING_SEARCH_NPROBE,
+    EMBEDDING_STORAGE, EMBEDDING_RESCORE, EMBEDDING_RESCORE_K
+)
+
+STORAGE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "int8": np.int8,
+}
+# Quantized rows are upcast into a reused float32 buffer this many rows at
+# a time; small enough to stay in cache, which beats one big astype().
+SCORE_CHUNK = 256
+# numpy converts float16 one element at a time on most CPUs, several times
+# slower than the matmul. Sign-extending the raw bits to int32, shifting
+# them left by 13 and masking with 0x8FFFFFFF gives, exactly (subnormals
+# too), the float32 bit pattern of x * 2**-112, the gap between the two
+# exponent biases; multiply by HALF_SCALE (or scale the query) to undo it.
+HALF_SCALE = np.float32(2.0 ** 112)
+_HALF_MASK = np.int32(-0x70000001)
+
+def _half_bits(rows, out):
+    """Write float16 rows into float32 out as x * 2**-112."""
+    bits = out.view(np.int32)
+    np.copyto(bits, rows.view(np.int16))
+    np.left_shift(bits, 13, out=bits)
+    np.bitwise_and(bits, _HALF_MASK, out=bits)
+
+class ExactIndex:
+    """Brute-force search over a slot-addressed embedding matrix.
+
+    Rows are L2-normalized so the dot product is the cosine similarity.
+    expires[slot] holds each row's expiry time (0 for a free slot), which
+    doubles as the TTL tombstone: dead rows stay put and are masked out.
+
+    storage picks the row format: "float32", "float16" (half the memory)
+    or "int8" (a quarter, plus one float32 scale per row). Quantized rows
+    are upcast block by block into a float32 buffer and scored there:
+    int8 is about as fast as float32, float16 (see _half_bits) a few
+    times slower. With rescore on, float32 copies are kept in an unlinked
+    temporary file and the top RESCORE_K candidates are rescored from it,
+    so near-threshold matches are decided at full precision while the hot
+    matrix stays small.
+    """
+
+    def __init__(self, capacity, storage=EMBEDDING_STORAGE, rescore=EMBEDDING_RESCORE,
+                 lock=None):
+        self.capacity = capacity
+        # The lock the owner holds around every call, if any; background
+        # work takes it to publish its results
+        self.lock = lock
+        self.storage = storage
+        self.rescore = rescore and storage != "float32"
+        self.matrix = None
+        self.scales = np.ones(capacity, dtype=np.float32) if storage == "int8" else None
+        self.full = None
+        self._buf = None
+        self.expires = np.zeros(capacity, dtype=np.float64)
+        self._high = 0  # one past the highest slot ever written
+
+    @property
+    def high(self):
+        """Number of leading slots that may hold data."""
+        return self._high
+
+    def row_bytes(self):
+        """In-memory bytes per stored embedding."""
+        if self.matrix is None:
+            return 0
+        return self.matrix.shape[1] * self.matrix.itemsize + (4 if self.scales is not None else 0)
+
+    def nbytes(self):
+        """Bytes held by the embedding matrix (and int8 scales)."""
+        return self.capacity * self.row_bytes()
+
+    def _ensure_matrix(self, dim):
+        if self.matrix is None:
+            self.matrix = np.zeros((self.capacity, dim), dtype=STORAGE_DTYPES[self.storage])
+        if self.rescore and self.full is None:
+            self.full = np.memmap(tempfile.TemporaryFile(), dtype=np.float32,
+                                  mode="w+", shape=(self.capacity, dim))
+
+    def add(self, slot, vec, expires_at):
+        self._ensure_matrix(vec.shape[0])
+        if self.scales is not None:
+            scale = max(float(np.abs(vec).max()), 1e-12) / 127
+            self.matrix[slot] = np.round(vec / scale)
+            self.scales[slot] = scale
+        else:
+            self.matrix[slot] = vec
+        if self.full is not None:
+            self.full[slot] = vec
+        self.expires[slot] = expires_at
+        self._high = max(self._high, slot + 1)
+
+    def vectors(self, slots):
+        """Dequantized float32 rows for slots."""
+        if self.matrix.dtype == np.float16:
+            half = self.matrix[slots]
+            rows = np.empty(half.shape, dtype=np.float32)
+            _half_bits(half, rows)
+            rows *= HALF_SCALE
+            return rows
+        rows = self.matrix[slots].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[slots, None]
+        return rows
+
+    def remove(self, slot):
+        self.expires[slot] = 0.0
+
+    def attach(self, matrix, scales=None, full=None):
+        """Adopt an existing (e.g. memory-mapped) capacity x dim matrix."""
+        self.matrix = matrix
+        if scales is not None:
+            self.scales = scales
+        if self.rescore:
+            if full is None:
+                # Snapshot saved without full-precision rows: rescore from
+                # the dequantized ones until they are overwritten
+                self._ensure_matrix(matrix.shape[1])
+                for start in range(0, self.capacity, SCORE_CHUNK):
+                    block = np.arange(start, min(start + SCORE_CHUNK, self.capacity))
+                    self.full[block] = self.vectors(block)
+            else:
+                self.full = full
+
+    def restore(self, slots, expires_at):
+        """Mark rows already present in an attached matrix as live."""
+        self.expires[slots] = expires_at
+        if len(slots):
+            self._high = max(self._high, int(slots.max()) + 1)
+
+    def clear(self):
+        self.expires[:] = 0.0
+        self._high = 0
+
+    def _scores(self, q, slots=None):
+        """Similarity of q to the given slots (default: every slot below high)."""
+        if slots is not None:
+            return self.vectors(slots) @ q
+        if self.matrix.dtype == np.float32:
+            return self.matrix[:self._high] @ q
+        if self._buf is None:
+            self._buf = np.empty((SCORE_CHUNK, self.matrix.shape[1]), dtype=np.float32)
+        half = self.matrix.dtype == np.float16
+        if half:
+            q = q * HALF_SCALE
+        sims = np.empty(self._high, dtype=np.float32)
+        for start in range(0, self._high, SCORE_CHUNK):
+            end = min(start + SCORE_CHUNK, self._high)
+            buf = self._buf[:end - start]
+            if half:
+                _half_bits(self.matrix[start:end], buf)
+            else:
+                np.copyto(buf, self.matrix[start:end])
+            np.dot(buf, q, out=sims[start:end])
+        if self.scales is not None:
+            sims *= self.scales[:self._high]
+        return sims
+
+    def _pick(self, sims, slots, q):
+        """Index into sims of the best row, rescored at full precision when
+        enabled. Dead rows must already be -inf."""
+        if self.full is None or len(sims) <= 1:
+            i = int(np.argmax(sims))
+            return i, float(sims[i])
+        k = min(EMBEDDING_RESCORE_K, len(sims))
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[sims[top] > -np.inf]
+        if len(top) == 0:
+            return 0, -np.inf
+        rows = top if slots is None else slots[top]
+        exact = self.full[rows] @ q
+        j = int(np.argmax(exact))
+        return int(top[j]), float(exact[j])
+
+    def _best(self, slots, q, now):
+        sims = self._scores(q, slots)
+        sims[self.expires[slots] <= now] = -np.inf
+        i, sim = self._pick(sims, slots, q)
+        return int(slots[i]), sim
+
+    def search(self, q, now):
+        """Return (slot, similarity) of the best live row, or (-1, -inf)."""
+        if self.matrix is None or self._high == 0:
+            return -1, -np.inf
+        sims = self._scores(q)
+        sims[self.expires[:self._high] <= now] = -np.inf
+        best, sim = self._pick(sims, None, q)
+        if sim == -np.inf:
+            return -1, -np.inf
+        return best, sim
+
+
+class IVFFlatIndex(ExactIndex):
+    """Inverted-file index over the same storage as ExactIndex.
+
+    Once IVF_TRAIN_SIZE rows are live, a spherical k-means picks nlist
+    centroids and every slot is filed under its nearest one. A query only
+    scores the rows in its nprobe closest lists, so nprobe is the
+    recall-vs-latency knob. Evicted slots are swap-removed from their list;
+    expired ones are left as tombstones until the cache evicts them.
+
+    With a lock, training runs on a background thread over a copy of the
+    sample and searches stay exact until the lists are swapped in; slots
+    written meanwhile are refiled then. Without one it runs inline.
+    """
+
+    def __init__(self, capacity, nlist=IVF_NLIST, nprobe=EMBEDDING_SEARCH_NPROBE,
+                 train_size=IVF_TRAIN_SIZE, seed=0, storage=EMBEDDING_STORAGE,
+                 rescore=EMBEDDING_RESCORE, lock=None):
+        super().__init__(capacity, storage, rescore, lock)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = max(train_size, nlist)
+        self.centroids = None
+        self._rng = np.random.default_rng(seed)
+        self._lists = []
+        self._sizes = None
+        self._list_of = np.full(capacity, -1, dtype=np.int32)
+        self._pos = np.zeros(capacity, dtype=np.int64)
+        self._live = 0
+        self._training = False
+        self._touched = None  # slots written since the training copy
+        self._epoch = 0  # bumped by clear() to void a training in flight
+
+    def _sample(self):
+        live = np.flatnonzero(self.expires[:self._high] > 0)
+        if len(live) > self.nlist * 64:
+            live = self._rng.choice(live, self.nlist * 64, replace=False)
+        return self.vectors(live)
+
+    def _kmeans(self, data):
+        nlist = min(self.nlist, len(data))
+        centroids = data[self._rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(10):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, data)
+            filled = np.bincount(assign, minlength=nlist) > 0
+            centroids[filled] = sums[filled]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        return centroids
+
+    def _nearest(self, centroids, slots):
+        assign = np.empty(len(slots), dtype=np.int64)
+        for start in range(0, len(slots), SCORE_CHUNK):
+            block = slots[start:start + SCORE_CHUNK]
+            assign[start:start + len(block)] = np.argmax(self.vectors(block) @ centroids.T, axis=1)
+        return assign
+
+    def _install(self, centroids, slots, assign):
+        """Adopt centroids and file slots under their assigned lists."""
+        self.nlist = len(centroids)
+        order = np.argsort(assign, kind="stable")
+        sizes = np.bincount(assign, minlength=self.nlist)
+        starts = np.cumsum(sizes) - sizes
+        filed = slots[order]
+        self._lists = []
+        for c in range(self.nlist):
+            members = np.empty(max(16, 2 * sizes[c]), dtype=np.int64)
+            members[:sizes[c]] = filed[starts[c]:starts[c] + sizes[c]]
+            self._lists.append(members)
+        self._sizes = sizes.astype(np.int64)
+        self._list_of[:] = -1
+        self._list_of[filed] = assign[order]
+        self._pos[filed] = np.arange(len(filed)) - starts[assign[order]]
+        self.centroids = centroids
+
+    def _train(self):
+        centroids = self._kmeans(self._sample())
+        live = np.flatnonzero(self.expires[:self._high] > 0)
+        self._install(centroids, live, self._nearest(centroids, live))
+
+    def _train_later(self, data, epoch):
+        centroids = self._kmeans(data)
+        with self.lock:
+            if epoch != self._epoch:
+                return
+            live = np.flatnonzero(self.expires[:self._high] > 0)
+        # Rows written while these are read are in _touched and redone below
+        assign = self._nearest(centroids, live)
+        with self.lock:
+            if epoch != self._epoch:
+                return
+            nearest = np.full(self.capacity, -1, dtype=np.int64)
+            nearest[live] = assign
+            nearest[list(self._touched)] = -1
+            live = np.flatnonzero(self.expires[:self._high] > 0)
+            stale = live[nearest[live] < 0]
+            nearest[stale] = self._nearest(centroids, stale)
+            self._install(centroids, live, nearest[live])
+            self._training = False
+            self._touched = None
+
+    def _maybe_train(self):
+        if self.centroids is not None or self._training or self._live < self.train_size:
+            return
+        if self.lock is None:
+            self._train()
+            return
+        self._training = True
+        self._touched = set()
+        threading.Thread(target=self._train_later, args=(self._sample(), self._epoch),
+                         daemon=True).start()
+
+    def _file(self, slot, vec):
+        c = int(np.argmax(self.centroids @ vec))
+        n = self._sizes[c]
+        if n == len(self._lists[c]):
+            grown = np.empty(n * 2, dtype=np.int64)
+            grown[:n] = self._lists[c]
+            self._lists[c] = grown
+        self._lists[c][n] = slot
+        self._sizes[c] = n + 1
+        self._list_of[slot] = c
+        self._pos[slot] = n
+
+    def _unfile(self, slot):
+        c = self._list_of[slot]
+        if c < 0:
+            return
+        last = self._sizes[c] - 1
+        pos = self._pos[slot]
+        moved = self._lists[c][last]
+        self._lists[c][pos] = moved
+        self._pos[moved] = pos
+        self._sizes[c] = last
+        self._list_of[slot] = -1
+
+    def add(self, slot, vec, expires_at):
+        if self.expires[slot] > 0:
+            self.remove(slot)
+        super().add(slot, vec, expires_at)
+        self._live += 1
+        if self.centroids is not None:
+            self._file(slot, vec)
+        else:
+            if self._touched is not None:
+                self._touched.add(slot)
+            self._maybe_train()
+
+    def remove(self, slot):
+        if self.expires[slot] > 0:
+            self._live -= 1
+        super().remove(slot)
+        if self.centroids is not None:
+            self._unfile(slot)
+        elif self._touched is not None:
+            self._touched.add(slot)
+
+    def restore(self, slots, expires_at):
+        super().restore(slots, expires_at)
+        self._live += len(slots)
+        if self.centroids is not None:
+            for slot, vec in zip(slots, self.vectors(slots)):
+                self._file(int(slot), vec)
+        else:
+            if self._touched is not None:
+                self._touched.update(slots.tolist())
+            self._maybe_train()
+
+    def clear(self):
+        super().clear()
+        self.centroids = None
+        self._lists = []
+        self._sizes = None
+        self._list_of[:] = -1
+        self._live = 0
+        self._training = False
+        self._touched = None
+        self._epoch += 1
+
+    def search(self, q, now):
+        if self.centroids is None:
+            return super().search(q, now)
+        nprobe = min(self.nprobe, self.nlist)
+        probe = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        slots = np.concatenate([self._lists[c][:self._sizes[c]] for c in probe])
+        if len(slots) == 0:
+            return -1, -np.inf
+        slot, sim = self._best(slots, q, now)
+        if sim == -np.inf:
+            return -1, -np.inf
+        return slot, sim
+
+
+INDEXES = {
+    "exact": ExactIndex,
+    "ivf": IVFFlatIndex,
+}
+
+def make_index(kind, capacity, storage=EMBEDDING_STORAGE, rescore=EMBEDDING_RESCORE, lock=None):
+    return INDEXES[kind](capacity, storage=storage, rescore=rescore, lock=lock)
@@ -0,0 +1,84 @@
+import asyncio
+
+class SingleFlight:
+    """Runs one computation per key at a time.
+
+    The first caller for a key (the leader) awaits fn(); callers arriving
+    while it is in flight await the same future instead of repeating it.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        """Return (result, leader) where leader is True for the caller that ran fn."""
+        future = self.calls.get(key)
+        if future is not None:
+            # shield: a follower's cancellation must not cancel the leader
+            return await asyncio.shield(future), False
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure is not logged as such
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            del self.calls[key]
+
+    def follow(self, key):
+        """Future of the call in flight for key, or None."""
+        return self.calls.get(key)
+
+    def pending(self):
+        return len(self.calls)
+
+inflight = SingleFlight()
+
+class Broadcast:
+    """Chunks of one streamed result, replayable by any number of readers.
+
+    Readers that join late get every chunk from the start, then follow
+    along live until finish().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.source = None  # how the leader resolved it: "miss", "semantic", ...
+        self.failed = False
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def push(self, chunk):
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, failed=False):
+        self.failed = failed
+        self.done = True
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def text(self):
+        return "".join([chunk async for chunk in self.subscribe()]).strip()
+
+# Streams in flight, by the same keys as inflight
+streams = {}
@@ -1,26 +1,60 @@
+import json
 import time
+import asyncio
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 import uvicorn
 import os
 
-from cache import cache
+from cache import cache, run_sweeper
 from analytics import analytics
-from config import AVG_TOKENS_PER_REQUEST
-from embeddings import embed
-from ai_service import ai_service
+from config import (
+    AVG_TOKENS_PER_REQUEST, SNAPSHOT_DIR, SNAPSHOT_INTERVAL_SECONDS, EMBED_CACHE_PATH,
+    SWEEP_INTERVAL_SECONDS, SHARED_SYNC_INTERVAL_SECONDS, STREAM_REPLAY_CHUNK_CHARS
+)
+import snapshot
+from embeddings import aembed, embed_cache
+from ai_service import async_ai_service
+from clients import close_async_client
+from inflight import inflight, streams, Broadcast
+from shared import shared_tier, run_sync
 from fastapi.middleware.cors import CORSMiddleware
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Clear cache on startup for fresh testing
-    cache.store.clear()
-    analytics.total_requests = 0
-    analytics.cache_hits = 0
-    analytics.cache_misses = 0
-    analytics.cached_tokens = 0
+    cache.clear()
+    analytics.reset()
+
+    if EMBED_CACHE_PATH:
+        embed_cache.load(EMBED_CACHE_PATH)
+
+    sweeper = asyncio.create_task(
+        run_sweeper(cache, SWEEP_INTERVAL_SECONDS, analytics.record_sweep)
+    )
+    syncer = None
+    if shared_tier:
+        syncer = asyncio.create_task(run_sync(shared_tier, cache, SHARED_SYNC_INTERVAL_SECONDS))
+    saver = None
+    if SNAPSHOT_DIR:
+        snapshot.load(cache, SNAPSHOT_DIR)
+        saver = asyncio.create_task(
+            snapshot.run_periodic(cache, SNAPSHOT_DIR, SNAPSHOT_INTERVAL_SECONDS)
+        )
     yield
+    sweeper.cancel()
+    if background:
+        await asyncio.gather(*background, return_exceptions=True)
+    if syncer:
+        syncer.cancel()
+    if saver:
+        saver.cancel()
+        await asyncio.to_thread(snapshot.save, cache, SNAPSHOT_DIR)
+    if EMBED_CACHE_PATH:
+        embed_cache.save(EMBED_CACHE_PATH)
+    await close_async_client()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -35,17 +69,32 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     query: str
     application: str
+    stream: bool = False  # answer as server-sent events
+
+def since(t):
+    return (time.perf_counter() - t) * 1000
 
 @app.post("/")
-def query_ai(req: QueryRequest):
+async def query_ai(req: QueryRequest):
     start = time.perf_counter()
     normalized = cache.normalize(req.query)
+    partition = cache.partition_name(req.application)
+    part = cache.partition(partition)
+    analytics.record_stage("normalize", since(start))
+
+    if req.stream:
+        return StreamingResponse(
+            stream_answer(start, partition, part, req.query, normalized),
+            media_type="text/event-stream"
+        )
 
     # 1. Exact cache check
-    answer = cache.get_exact(normalized)
+    t = time.perf_counter()
+    answer = part.get_exact(normalized)
+    analytics.record_stage("exact_lookup", since(t))
     if answer:
         latency = round(max(0.01, (time.perf_counter() - start) * 1000), 2)
-        analytics.record_hit(latency, AVG_TOKENS_PER_REQUEST)
+        analytics.record_hit(latency, AVG_TOKENS_PER_REQUEST, partition=partition)
         return {
             "answer": answer,
             "cached": True,
@@ -53,54 +102,263 @@ def query_ai(req: QueryRequest):
             "cacheKey": cache._hash(normalized)
         }
 
-    # 2. Semantic cache check
-    emb = embed(normalized)
-    answer = cache.get_semantic(emb)
-    if answer:
-        latency = round(max(0.01, (time.perf_counter() - start) * 1000), 2)
-        analytics.record_hit(latency, AVG_TOKENS_PER_REQUEST)
+    # 2-3. Semantic check, then LLM on a miss. Concurrent requests for the
+    # same normalized query share one leader instead of each calling the LLM.
+    key = (partition, cache._hash(normalized))
+    broadcast = streams.get(key)
+    if broadcast:
+        # A streamed request is already resolving it; if its upstream
+        # failed, this request got the error text, not a cached answer
+        answer, leader = await broadcast.text(), False
+        hit_type = "error" if broadcast.failed else "coalesced"
+    else:
+        (answer, hit_type), leader = await inflight.do(
+            key, lambda: resolve_miss(partition, part, req.query, normalized)
+        )
+    if not leader and hit_type != "error":
+        hit_type = "coalesced"
+
+    latency = round(max(0.01, (time.perf_counter() - start) * 1000), 2)
+    if hit_type in ("miss", "error"):
+        analytics.record_miss(latency, partition)
         return {
             "answer": answer,
-            "cached": True,
+            "cached": False,
             "latency": latency,
-            "cacheKey": "semantic_" + cache._hash(normalized)[:8]
+            "cacheKey": cache._hash(normalized)
         }
 
-    # 3. Cache Miss - Real LLM call
-    answer = ai_service.query(req.query)
-
-    # Store in cache with the embedding we already computed
-    cache.set_with_embedding(normalized, answer, emb)
-
-    latency = round(max(0.01, (time.perf_counter() - start) * 1000), 2)
-    analytics.record_miss(latency)
-
+    analytics.record_hit(latency, AVG_TOKENS_PER_REQUEST, hit_type, partition)
     return {
         "answer": answer,
-        "cached": False,
+        "cached": True,
         "latency": latency,
-        "cacheKey": cache._hash(normalized)
+        "cacheKey": hit_type + "_" + cache._hash(normalized)[:8]
     }
 
+def sse(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+async def replay(answer):
+    for i in range(0, len(answer), STREAM_REPLAY_CHUNK_CHARS):
+        yield answer[i:i + STREAM_REPLAY_CHUNK_CHARS]
+
+async def stream_answer(start, partition, part, query, normalized):
+    """Server-sent events: {"delta": ...} chunks, then a final event with
+    "done": true and the same fields as the JSON response."""
+    t = time.perf_counter()
+    answer = part.get_exact(normalized)
+    analytics.record_stage("exact_lookup", since(t))
+
+    key = (partition, cache._hash(normalized))
+    broadcast = None
+    if answer:
+        hit_type, chunks = "exact", replay(answer)
+    elif (future := inflight.follow(key)) is not None:
+        # A JSON request is already resolving it
+        answer, hit_type = await asyncio.shield(future)
+        # A failed leader's error text is no cache hit for its followers
+        hit_type, chunks = "miss" if hit_type == "error" else "coalesced", replay(answer)
+    else:
+        broadcast = streams.get(key)
+        hit_type = "coalesced"
+        if broadcast is None:
+            # Lead: resolve in a task of its own, so a client that
+            # disconnects does not abort the answer other readers wait on
+            broadcast = streams[key] = Broadcast()
+            hit_type = None
+            task = asyncio.create_task(lead_stream(key, partition, part, query, normalized, broadcast))
+            background.add(task)
+            task.add_done_callback(background.discard)
+        chunks = broadcast.subscribe()
+
+    first = True
+    async for chunk in chunks:
+        if first:
+            # A leader learns its tier when the lookup finishes, which is
+            # before the first chunk
+            hit_type = hit_type or broadcast.source
+            analytics.record_ttft(hit_type, since(start))
+            first = False
+        yield sse({"delta": chunk})
+    hit_type = hit_type or broadcast.source
+    if hit_type == "coalesced" and broadcast is not None and broadcast.failed:
+        hit_type = "miss"  # the leader's upstream failed: no answer was reused
+
+    latency = round(max(0.01, (time.perf_counter() - start) * 1000), 2)
+    cached = hit_type != "miss"
+    if cached:
+        analytics.record_hit(latency, AVG_TOKENS_PER_REQUEST, hit_type, partition)
+    else:
+        analytics.record_miss(latency, partition)
+    yield sse({
+        "done": True,
+        "cached": cached,
+        "latency": latency,
+        "cacheKey": key[1] if hit_type in ("exact", "miss") else hit_type + "_" + key[1][:8]
+    })
+
+async def lead_stream(key, partition, part, query, normalized, broadcast):
+    """Resolve a streamed miss into broadcast: a cached answer is pushed
+    whole, an LLM answer chunk by chunk and cached once complete."""
+    failed = False
+    try:
+        answer, hit_type, emb, sig = await lookup_miss(partition, part, normalized)
+        broadcast.source = hit_type
+        if answer is not None:
+            broadcast.push(answer)
+            return
+
+        t = time.perf_counter()
+        try:
+            async for chunk in async_ai_service.stream(query):
+                broadcast.push(chunk)
+        except Exception as e:
+            print(f"LLM error: {e}")
+            broadcast.push(f"Error: Could not process request. {str(e)}")
+            failed = True
+            return
+        analytics.record_stage("llm", since(t))
+        await cache_answer(partition, part, normalized, "".join(broadcast.chunks).strip(), emb, sig)
+    except Exception as e:
+        print(f"Stream error: {e}")
+        broadcast.source = broadcast.source or "miss"
+        failed = True
+    finally:
+        broadcast.finish(failed)
+        del streams[key]
+
+async def resolve_miss(partition, part, query, normalized):
+    """Returns (answer, hit type): "shared" or "semantic" on a hit, else
+    calls the LLM and returns (answer, "miss"). If the LLM call fails the
+    error text comes back as (text, "error") and nothing is cached."""
+    answer, hit_type, emb, sig = await lookup_miss(partition, part, normalized)
+    if answer is not None:
+        return answer, hit_type
+
+    # 3. Cache Miss - Real LLM call
+    t = time.perf_counter()
+    try:
+        answer, tokens = await async_ai_service.query(query)
+    except Exception as e:
+        print(f"LLM error: {e}")
+        return f"Error: Could not process request. {str(e)}", "error"
+    analytics.record_stage("llm", since(t))
+
+    # GreedyDual-Size weighs entries by what a miss actually cost
+    await cache_answer(partition, part, normalized, answer, emb, sig, tokens)
+    return answer, "miss"
+
+async def lookup_miss(partition, part, normalized):
+    """Shared-tier and semantic lookups for an exact miss. Returns
+    (answer, hit type, embedding, pre-filter signature); on a miss answer
+    is None, and embedding is None if the pre-filter skipped it."""
+    key = cache._hash(normalized)
+    if shared_tier:
+        # Another worker may already have answered this exact query
+        row = await asyncio.to_thread(shared_tier.get, partition, key)
+        if row:
+            answer, vec, created, cost, sig = row
+            await asyncio.to_thread(part.insert, key, answer, vec, created, cost, sig)
+            return answer, "shared", vec, sig
+
+    sig = part.sketch(normalized)
+    if sig is not None:
+        skip = not part.may_match(sig)
+        analytics.record_prefilter(skip)
+        if skip:
+            # No cached query shares any n-gram band: go straight to the
+            # LLM and embed for insertion once the answer is out
+            return None, "miss", None, sig
+
+    # 2. Semantic cache check
+    t = time.perf_counter()
+    emb = await aembed(normalized)
+    analytics.record_stage("embed", since(t))
+
+    t = time.perf_counter()
+    answer = await asyncio.to_thread(part.get_semantic, emb)
+    analytics.record_stage("semantic_scan", since(t))
+    if answer:
+        return answer, "semantic", emb, sig
+    return None, "miss", emb, sig
+
+async def cache_answer(partition, part, normalized, answer, emb, sig, cost=None):
+    """Cache answer; cost is its token cost, estimated from the text if
+    not given."""
+    if emb is not None:
+        # Store in cache with the embedding we already computed
+        await store(partition, part, normalized, answer, emb, sig, cost)
+        return
+    task = asyncio.create_task(store_later(partition, part, normalized, answer, sig, cost))
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+async def store(partition, part, normalized, answer, emb, sig, cost=None):
+    # Scanning and filing embeddings is CPU-bound: keep it off the event loop
+    entry = await asyncio.to_thread(part.set_with_embedding, normalized, answer, emb, cost=cost, sig=sig)
+    if shared_tier:
+        await asyncio.to_thread(
+            shared_tier.put, partition, cache._hash(normalized), answer, part._as_unit(emb),
+            entry.timestamp, entry.timestamp + part.ttl, entry.cost, sig
+        )
+
+background = set()  # tasks kept alive until done
+
+async def store_later(partition, part, normalized, answer, sig, cost=None):
+    """Embed and cache an answer the pre-filter sent straight to the LLM.
+    A semantic match found now means the filter skipped a hit."""
+    try:
+        emb = await aembed(normalized)
+        if await asyncio.to_thread(part.has_semantic, emb):
+            analytics.record_prefilter_false_negative()
+        await store(partition, part, normalized, answer, emb, sig, cost)
+    except Exception as e:
+        print(f"Background insert failed: {e}")
+
 @app.get("/analytics")
 def get_analytics():
     report = analytics.report()
-    report["cacheSize"] = len(cache.store)
+    report["cacheSize"] = cache.size()
+    partitions = analytics.partition_report()
+    for name, part in cache.items():
+        partitions.setdefault(name, {}).update({
+            "cacheSize": len(part.store),
+            "maxSize": part.max_size,
+            "ttl": part.ttl,
+            "threshold": part.threshold,
+            "embeddingStorage": part.index.storage,
+            "embeddingBytes": part.index.nbytes()
+        })
+    report["partitions"] = partitions
+    report["expiredEntries"] = cache.expired
+    if shared_tier:
+        report["sharedTier"] = {"size": shared_tier.size(), "hits": shared_tier.hits}
+    report["embeddingCache"] = embed_cache.stats()
     report["strategies"] = [
         "exact match",
         "semantic similarity",
+        "n-gram pre-filter",
+        "request coalescing",
+        "shared worker tier",
         "LRU eviction",
         "TTL expiration"
     ]
     return report
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text exposition of counters and latency histograms"""
+    return analytics.prometheus()
+
 @app.post("/reset")
 def reset_cache():
-    cache.store.clear()
-    analytics.total_requests = 0
-    analytics.cache_hits = 0
-    analytics.cache_misses = 0
-    analytics.cached_tokens = 0
+    cache.clear()
+    if shared_tier:
+        shared_tier.reset()
+    if SNAPSHOT_DIR:
+        snapshot.wipe(SNAPSHOT_DIR)
+    analytics.reset()
     return {"status": "reset", "message": "Cache and analytics cleared"}
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+import heapq
+from collections import OrderedDict
+
+import numpy as np
+
+class LRUPolicy:
+    """Evicts the least recently used entry; admits everything."""
+
+    def __init__(self, capacity):
+        self.order = OrderedDict()
+
+    def record(self, key):
+        pass
+
+    def on_insert(self, key, cost, size):
+        self.order[key] = None
+
+    def on_restore(self, key, cost, size):
+        # Snapshot entries arrive newest first, behind everything cached
+        self.order[key] = None
+        self.order.move_to_end(key, last=False)
+
+    def on_hit(self, key):
+        self.order.move_to_end(key)
+
+    def on_remove(self, key):
+        self.order.pop(key, None)
+
+    def victim(self):
+        return next(iter(self.order))
+
+    def clear(self):
+        self.order.clear()
+
+
+class FrequencySketch:
+    """Count-min sketch of 4-bit-style counters (capped at 15).
+
+    Every sample_size increments all counters are halved, so frequency
+    estimates favour recent popularity.
+    """
+
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+
+    def __init__(self, capacity):
+        width = 1
+        while width < max(16, capacity):
+            width <<= 1
+        self.mask = width - 1
+        self.table = np.zeros((len(self.SEEDS), width), dtype=np.uint8)
+        self.rows = np.arange(len(self.SEEDS))
+        self.sample_size = 10 * max(16, capacity)
+        self.additions = 0
+
+    def _cols(self, key):
+        h = int(key[:16], 16)
+        return [((h * seed) >> 32) & self.mask for seed in self.SEEDS]
+
+    def increment(self, key):
+        cols = self._cols(key)
+        counts = self.table[self.rows, cols]
+        self.table[self.rows, cols] = np.minimum(counts + 1, 15)
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.table >>= 1
+            self.additions //= 2
+
+    def frequency(self, key):
+        return int(self.table[self.rows, self._cols(key)].min())
+
+    def clear(self):
+        self.table[:] = 0
+        self.additions = 0
+
+
+class TinyLFUPolicy:
+    """W-TinyLFU-style admission.
+
+    New entries land in a small LRU window (1% of capacity). Once the cache
+    is full, the window's oldest entry duels the main region's LRU victim
+    and the one the frequency sketch has seen less often is evicted, so
+    one-off queries cannot flush entries that are asked again and again.
+    """
+
+    def __init__(self, capacity, window_fraction=0.01):
+        self.sketch = FrequencySketch(capacity)
+        self.window_size = max(1, int(capacity * window_fraction))
+        self.window = OrderedDict()
+        self.main = OrderedDict()
+
+    def record(self, key):
+        self.sketch.increment(key)
+
+    def on_insert(self, key, cost, size):
+        self.window[key] = None
+        # Until the cache fills up, overflow moves to main without a duel
+        while len(self.window) > self.window_size:
+            self.main[self.window.popitem(last=False)[0]] = None
+
+    def on_restore(self, key, cost, size):
+        # Snapshot entries arrive newest first and go behind the main
+        # region, so they are the first to duel new candidates
+        self.main[key] = None
+        self.main.move_to_end(key, last=False)
+
+    def on_hit(self, key):
+        if key in self.window:
+            self.window.move_to_end(key)
+        else:
+            self.main.move_to_end(key)
+
+    def on_remove(self, key):
+        if key in self.window:
+            del self.window[key]
+        else:
+            self.main.pop(key, None)
+
+    def victim(self):
+        if not self.main:
+            return next(iter(self.window))
+        if len(self.window) < self.window_size:
+            return next(iter(self.main))
+
+        candidate = next(iter(self.window))
+        incumbent = next(iter(self.main))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(incumbent):
+            # Admit the window's candidate into the main region
+            del self.window[candidate]
+            self.main[candidate] = None
+            return incumbent
+        return candidate
+
+    def clear(self):
+        self.sketch.clear()
+        self.window.clear()
+        self.main.clear()
+
+
+class GreedyDualSizePolicy:
+    """GreedyDual-Size: priority H = L + cost / size.
+
+    cost is the entry's token cost and size its bytes, so cheap, bulky
+    answers go first. L inflates to each victim's H, which ages out entries
+    that have not been hit since it was lower.
+    """
+
+    def __init__(self, capacity):
+        self.clear()
+
+    def record(self, key):
+        pass
+
+    def _push(self, key):
+        self.seq += 1
+        h = self.inflation + self.value[key]
+        self.priority[key] = h
+        heapq.heappush(self.heap, (h, self.seq, key))
+
+    def on_insert(self, key, cost, size):
+        self.value[key] = cost / max(size, 1)
+        self._push(key)
+
+    # Priority, not arrival order, decides eviction
+    on_restore = on_insert
+
+    def on_hit(self, key):
+        self._push(key)
+
+    def on_remove(self, key):
+        self.priority.pop(key, None)
+        self.value.pop(key, None)
+        if len(self.heap) > 4 * len(self.priority) + 1024:
+            self.heap = [item for item in self.heap if self.priority.get(item[2]) == item[0]]
+            heapq.heapify(self.heap)
+
+    def victim(self):
+        # Skip heap items left behind by hits and removals
+        while self.priority.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        h, _, key = self.heap[0]
+        self.inflation = h
+        return key
+
+    def clear(self):
+        self.inflation = 0.0
+        self.priority = {}
+        self.value = {}
+        self.heap = []
+        self.seq = 0
+
+
+POLICIES = {
+    "lru": LRUPolicy,
+    "tinylfu": TinyLFUPolicy,
+    "gds": GreedyDualSizePolicy,
+}
+
+def make_policy(kind, capacity):
+    return POLICIES[kind](capacity)
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text
+    return max(1, len(text) // 4)
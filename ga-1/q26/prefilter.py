@@ -0,0 +1,124 @@
+"""MinHash LSH pre-filter over cached normalized queries.
+
+Each cached query gets a MinHash signature of its character n-grams,
+split into bands. Two queries share a band bucket with probability
+1 - (1 - J**rows)**bands for n-gram Jaccard similarity J, so a query that
+shares no bucket with any cached entry almost certainly has no lexical
+overlap with them. Such queries skip the embedding call and go straight
+to the LLM. Paraphrases with little lexical overlap are the false
+negatives; main.py measures how often that happens.
+"""
+import re
+import zlib
+
+import numpy as np
+
+from config import PREFILTER_BANDS, PREFILTER_ROWS, PREFILTER_NGRAM
+
+_NON_WORD = re.compile(r"\W+")
+
+class MinHashFilter:
+    def __init__(self, capacity, bands=PREFILTER_BANDS, rows=PREFILTER_ROWS,
+                 ngram=PREFILTER_NGRAM, seed=0):
+        self.capacity = capacity
+        self.bands = bands
+        self.rows = rows
+        self.ngram = ngram
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: the high 32 bits of a * h + b
+        self._a = rng.integers(1, 2**63, bands * rows, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, bands * rows, dtype=np.uint64)
+        # Slot-addressed signatures; an all-zero row means "no signature"
+        self.sigs = np.zeros((capacity, bands * rows), dtype=np.uint32)
+        self._buckets = [{} for _ in range(bands)]
+        self._known = np.zeros(capacity, dtype=bool)
+        self._live = np.zeros(capacity, dtype=bool)
+        self.unsketched = 0  # live slots without a signature
+
+    def signature(self, text):
+        text = _NON_WORD.sub(" ", text).strip()
+        n = self.ngram
+        shingles = {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+        h = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+        sig = ((h[:, None] * self._a + self._b) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+        sig[sig == 0] = 1  # keep 0 free as the "no signature" marker
+        return sig
+
+    def _band_keys(self, sig):
+        return [sig[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def _file(self, slot, bands=None):
+        if bands is None:
+            bands = self._band_keys(self.sigs[slot])
+        for bucket, band in zip(self._buckets, bands):
+            bucket.setdefault(band, set()).add(slot)
+
+    def add(self, slot, sig=None):
+        if self._live[slot]:
+            self.remove(slot)
+        self._live[slot] = True
+        if sig is None:
+            self.sigs[slot] = 0
+            self._known[slot] = False
+            self.unsketched += 1
+            return
+        self.sigs[slot] = sig
+        self._known[slot] = True
+        self._file(slot)
+
+    def remove(self, slot):
+        if not self._live[slot]:
+            return
+        self._live[slot] = False
+        if not self._known[slot]:
+            self.unsketched -= 1
+            return
+        for bucket, band in zip(self._buckets, self._band_keys(self.sigs[slot])):
+            slots = bucket.get(band)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del bucket[band]
+
+    def may_match(self, sig):
+        """False only if no cached entry shares a band with sig."""
+        if self.unsketched:
+            # Entries of unknown text could match anything
+            return True
+        return any(band in bucket for bucket, band in zip(self._buckets, self._band_keys(sig)))
+
+    def attach(self, sigs):
+        """Adopt signatures saved with a snapshot (capacity x bands*rows),
+        e.g. a copy-on-write memory map."""
+        if sigs is not None and sigs.shape == self.sigs.shape:
+            self.sigs = sigs
+
+    def bands_of(self, slots):
+        """Band keys of each slot's attached signature (None if it has
+        none), for restore(). Reads only, so callers need no lock."""
+        sigs = np.asarray(self.sigs[slots]).reshape(len(slots), self.bands, self.rows)
+        band = np.dtype((np.void, self.rows * sigs.itemsize))
+        columns = [np.ascontiguousarray(sigs[:, b]).view(band).ravel().tolist()
+                   for b in range(self.bands)]
+        known = sigs.any(axis=(1, 2)).tolist()
+        return [bands if k else None for bands, k in zip(zip(*columns), known)]
+
+    def restore(self, slots, bands):
+        """Mark slots of an attached signature matrix as live, given their
+        band keys from bands_of()."""
+        for slot, keys in zip(slots, bands):
+            self._live[slot] = True
+            self._known[slot] = keys is not None
+            if keys is not None:
+                self._file(slot, keys)
+            else:
+                self.unsketched += 1
+
+    def clear(self):
+        # A fresh array: zeroing an attached snapshot map would dirty
+        # every page of it
+        self.sigs = np.zeros((self.capacity, self.bands * self.rows), dtype=np.uint32)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._known[:] = False
+        self._live[:] = False
+        self.unsketched = 0
@@ -0,0 +1,217 @@
+"""Shared second cache tier for multiple workers, in one SQLite (WAL) file.
+
+Every worker keeps its own in-process cache (L1) in front of it:
+
+  * L1 misses check the shared tier by exact key before embedding, and
+    new answers are written through to it.
+  * sync_into() pulls entries other workers wrote since the last call into
+    L1, so semantic lookups also see them.
+  * Entries keep the timestamp of the worker that produced them, so every
+    copy expires at the same moment.
+  * When the shared tier evicts an entry for space, it logs the eviction.
+    Workers drop the same key from L1, so L1 only ever holds entries the
+    shared tier also holds.
+  * reset() bumps a generation counter that makes every worker clear its L1.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from config import SHARED_CACHE_PATH, SHARED_MAX_SIZE, SHARED_SYNC_BATCH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    partition TEXT NOT NULL,
+    key TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    created REAL NOT NULL,
+    expires REAL NOT NULL,
+    cost REAL NOT NULL,
+    sketch BLOB,
+    UNIQUE (partition, key)
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS sizes (partition TEXT PRIMARY KEY, size INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS evictions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    partition TEXT NOT NULL,
+    key TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+"""
+
+EVICTION_LOG_SECONDS = 3600  # how long workers have to catch up on evictions
+
+def _sig(blob):
+    return None if blob is None else np.frombuffer(blob, dtype=np.uint32)
+
+class SharedTier:
+    def __init__(self, path, max_size=SHARED_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size  # entries per partition
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+        # Start from the beginning of the entries table, which warms a new
+        # worker's L1, but only act on evictions from now on.
+        self.last_seq = 0
+        self.last_eviction = self._scalar("SELECT COALESCE(MAX(id), 0) FROM evictions")
+        self.generation = self._scalar("SELECT value FROM meta WHERE name = 'generation'")
+        self.hits = 0
+
+    def _conn(self):
+        # sqlite3 connections are per thread; asyncio.to_thread uses a pool
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _scalar(self, sql, *args):
+        return self._conn().execute(sql, args).fetchone()[0]
+
+    def get(self, partition, key):
+        """Returns (answer, embedding, created, cost, sketch) of a live entry,
+        or None. sketch is the pre-filter signature, if one was stored."""
+        row = self._conn().execute(
+            "SELECT answer, embedding, created, cost, sketch FROM entries"
+            " WHERE partition = ? AND key = ? AND expires > ?",
+            (partition, key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        answer, embedding, created, cost, sketch = row
+        return answer, np.frombuffer(embedding, dtype=np.float32), created, cost, _sig(sketch)
+
+    def put(self, partition, key, answer, vec, created, expires, cost, sig=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            existed = conn.execute(
+                "DELETE FROM entries WHERE partition = ? AND key = ?", (partition, key)
+            ).rowcount
+            conn.execute(
+                "INSERT INTO entries (partition, key, answer, embedding, created, expires, cost, sketch)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (partition, key, answer, np.asarray(vec, dtype=np.float32).tobytes(),
+                 created, expires, cost, None if sig is None else sig.tobytes())
+            )
+            if not existed:
+                conn.execute(
+                    "INSERT INTO sizes VALUES (?, 1)"
+                    " ON CONFLICT (partition) DO UPDATE SET size = size + 1",
+                    (partition,)
+                )
+            size = conn.execute(
+                "SELECT size FROM sizes WHERE partition = ?", (partition,)
+            ).fetchone()[0]
+            if size > self.max_size:
+                self._evict(conn, partition, size - self.max_size)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn, partition, count):
+        # First in, first out: the shared tier never sees L1 hits, so it has
+        # no recency to go on.
+        victims = conn.execute(
+            "SELECT seq, key FROM entries WHERE partition = ? ORDER BY seq LIMIT ?",
+            (partition, count)
+        ).fetchall()
+        now = time.time()
+        conn.executemany("DELETE FROM entries WHERE seq = ?", [(seq,) for seq, _ in victims])
+        conn.executemany(
+            "INSERT INTO evictions (partition, key, at) VALUES (?, ?, ?)",
+            [(partition, key, now) for _, key in victims]
+        )
+        conn.execute("UPDATE sizes SET size = size - ? WHERE partition = ?", (len(victims), partition))
+
+    def sweep(self):
+        """Delete expired entries. Not logged: L1 expires them on its own."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = conn.execute(
+                "SELECT partition, COUNT(*) FROM entries WHERE expires <= ? GROUP BY partition", (now,)
+            ).fetchall()
+            conn.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            conn.executemany(
+                "UPDATE sizes SET size = size - ? WHERE partition = ?",
+                [(count, partition) for partition, count in expired]
+            )
+            conn.execute("DELETE FROM evictions WHERE at < ?", (now - EVICTION_LOG_SECONDS,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def sync_into(self, cache):
+        """Apply other workers' inserts, evictions and resets to this
+        worker's PartitionedCache. Returns the number of entries pulled."""
+        conn = self._conn()
+        generation = self._scalar("SELECT value FROM meta WHERE name = 'generation'")
+        if generation != self.generation:
+            cache.clear()
+            self.generation = generation
+            self.last_seq = 0
+
+        evictions = conn.execute(
+            "SELECT id, partition, key FROM evictions WHERE id > ? ORDER BY id", (self.last_eviction,)
+        ).fetchall()
+        for eviction_id, partition, key in evictions:
+            cache.partition(partition).discard(key)
+            self.last_eviction = eviction_id
+
+        rows = conn.execute(
+            "SELECT seq, partition, key, answer, embedding, created, cost, sketch FROM entries"
+            " WHERE seq > ? AND expires > ? ORDER BY seq LIMIT ?",
+            (self.last_seq, time.time(), SHARED_SYNC_BATCH)
+        ).fetchall()
+        for seq, partition, key, answer, embedding, created, cost, sketch in rows:
+            part = cache.partition(partition)
+            if key not in part.store:
+                part.insert(key, answer, np.frombuffer(embedding, dtype=np.float32),
+                            created, cost, _sig(sketch))
+            self.last_seq = seq
+        return len(rows)
+
+    def reset(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM sizes")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.generation = self._scalar("SELECT value FROM meta WHERE name = 'generation'")
+        self.last_seq = self._scalar("SELECT COALESCE(MAX(seq), 0) FROM entries")
+
+    def size(self):
+        return self._scalar("SELECT COALESCE(SUM(size), 0) FROM sizes")
+
+async def run_sync(tier, cache, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Drain a backlog in SHARED_SYNC_BATCH steps
+            while await asyncio.to_thread(tier.sync_into, cache) == SHARED_SYNC_BATCH:
+                pass
+            await asyncio.to_thread(tier.sweep)
+        except sqlite3.Error as e:
+            print(f"Shared cache sync error: {e}")
+
+shared_tier = SharedTier(SHARED_CACHE_PATH) if SHARED_CACHE_PATH else None
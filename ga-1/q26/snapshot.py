@@ -0,0 +1,232 @@
+"""On-disk snapshot of the cache so restarts come up warm.
+
+A snapshot directory holds one subdirectory per cache partition, each with:
+  matrix.npy     slot-addressed embeddings (capacity x dim) in the
+                 index's storage format
+  scales.npy     per-row scales (int8 storage only)
+  full.npy       float32 copies of quantized rows (when rescoring)
+  sigs.npy       pre-filter MinHash signatures (when the filter is on)
+  keys.npy       store keys in LRU order (oldest first)
+  slots.npy      matrix row of each key
+  timestamps.npy insertion time of each key
+  costs.npy      token cost of each answer (for cost-aware eviction)
+  offsets.npy    byte offsets of each answer in answers.bin
+  answers.bin    UTF-8 answers, concatenated
+  meta.json      format version, partition name, capacity, dimension
+                 and storage format
+
+Loading memory-maps everything, so only the pages a lookup touches are
+read. Live entries are inserted into the store in the background and
+answers are decoded from the mapped file on first use.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from cache import CacheEntry
+VERSION = 2
+RESTORE_CHUNK = 256  # entries published per hold of the cache lock
+SAVE_CHUNK_ROWS = 4096  # rows copied per hold of the cache lock
+
+_save_lock = threading.Lock()
+
+class SnapshotEntry(CacheEntry):
+    def __init__(self, blob, start, end, slot, timestamp, cost):
+        self._blob = blob
+        self._start = start
+        self._end = end
+        self.slot = slot
+        self.timestamp = timestamp
+        self.cost = cost
+
+    @property
+    def answer(self):
+        return bytes(self._blob[self._start:self._end]).decode()
+
+    def answer_size(self):
+        return self._end - self._start
+
+def _sources(cache):
+    index = cache.index
+    sources = [("matrix.npy", index.matrix)]
+    if index.scales is not None:
+        sources.append(("scales.npy", index.scales))
+    if index.full is not None:
+        sources.append(("full.npy", index.full))
+    if cache.prefilter:
+        sources.append(("sigs.npy", cache.prefilter.sigs))
+    return sources
+
+def _write_partition(cache, name, path):
+    os.makedirs(path)
+    # Lookups on the event loop wait for cache.lock, so rows are copied
+    # under it SAVE_CHUNK_ROWS at a time. Slots rewritten meanwhile are
+    # recorded by the cache and copied again with the entries at the end,
+    # which is the moment the snapshot reflects. File I/O is lock-free.
+    with cache.lock:
+        if cache.index.matrix is None:
+            return 0
+        generation = cache.generation
+        cache.written = set()
+        high = cache.index.high
+        copies = [(filename, source.shape, np.empty((high,) + source.shape[1:], dtype=source.dtype))
+                  for filename, source in _sources(cache)]
+    try:
+        for start in range(0, high, SAVE_CHUNK_ROWS):
+            end = min(start + SAVE_CHUNK_ROWS, high)
+            with cache.lock:
+                if cache.generation != generation:
+                    return 0  # cleared or restored meanwhile
+                for (_, _, rows), (_, source) in zip(copies, _sources(cache)):
+                    rows[start:end] = source[start:end]
+
+        with cache.lock:
+            if cache.generation != generation:
+                return 0
+            items = list(cache.store.items())
+            rewritten = np.array(sorted(s for s in cache.written if s < high), dtype=np.int64)
+            new_high = cache.index.high
+            arrays = []
+            for (filename, shape, rows), (_, source) in zip(copies, _sources(cache)):
+                rows[rewritten] = source[rewritten]
+                if new_high > high:
+                    rows = np.concatenate([rows, source[high:new_high]])
+                arrays.append((filename, shape, rows))
+            high = new_high
+            dim = cache.index.matrix.shape[1]
+            storage = cache.index.storage
+    finally:
+        with cache.lock:
+            cache.written = None
+    del copies
+
+    # Rows past `high` are never written, so the files stay sparse.
+    for filename, shape, rows in arrays:
+        out = np.lib.format.open_memmap(
+            os.path.join(path, filename), mode="w+", dtype=rows.dtype, shape=shape
+        )
+        out[:high] = rows
+        out.flush()
+        del out
+    del arrays
+
+    answers = [entry.answer.encode() for _, entry in items]
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in answers], out=offsets[1:])
+    with open(os.path.join(path, "answers.bin"), "wb") as f:
+        f.write(b"".join(answers))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "keys.npy"), np.array([k for k, _ in items], dtype="S32"))
+    np.save(os.path.join(path, "slots.npy"), np.array([e.slot for _, e in items], dtype=np.int64))
+    np.save(os.path.join(path, "timestamps.npy"), np.array([e.timestamp for _, e in items]))
+    np.save(os.path.join(path, "costs.npy"), np.array([e.cost for _, e in items], dtype=np.float64))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"version": VERSION, "partition": name, "capacity": cache.max_size,
+                   "dim": dim, "storage": storage, "count": len(items),
+                   "savedAt": time.time()}, f)
+    return len(items)
+
+def save(cache, path):
+    """Write every partition to path, replacing any previous snapshot."""
+    with _save_lock:
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        saved = 0
+        for name, part in cache.items():
+            subdir = hashlib.md5(name.encode()).hexdigest()[:16]
+            saved += _write_partition(part, name, os.path.join(tmp, subdir))
+
+        old = path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+        return saved
+
+def load(cache, path):
+    """Map a snapshot into the partitioned cache and restore live entries in
+    the background. Returns the restoring threads."""
+    threads = []
+    if not os.path.isdir(path):
+        return threads
+    for subdir in sorted(os.listdir(path)):
+        try:
+            with open(os.path.join(path, subdir, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get("version") != VERSION:
+            continue
+        thread = _load_partition(cache.partition(meta["partition"]), meta, os.path.join(path, subdir))
+        if thread:
+            threads.append(thread)
+    return threads
+
+def _load_partition(cache, meta, path):
+    if meta.get("capacity") != cache.max_size or meta.get("storage") != cache.index.storage:
+        print(f"Snapshot at {path} does not match this cache; ignoring it")
+        return None
+
+    def arr(name):
+        return np.load(os.path.join(path, name), mmap_mode="r")
+
+    # Copy-on-write: new inserts write private pages, never the snapshot.
+    matrix = np.load(os.path.join(path, "matrix.npy"), mmap_mode="c")
+    scales = full = None
+    if os.path.exists(os.path.join(path, "scales.npy")):
+        scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="c")
+    if cache.index.rescore and os.path.exists(os.path.join(path, "full.npy")):
+        full = np.load(os.path.join(path, "full.npy"), mmap_mode="c")
+    sigs = None
+    if cache.prefilter and os.path.exists(os.path.join(path, "sigs.npy")):
+        sigs = np.load(os.path.join(path, "sigs.npy"), mmap_mode="c")
+    keys, slots, timestamps, offsets = arr("keys.npy"), arr("slots.npy"), arr("timestamps.npy"), arr("offsets.npy")
+    costs = arr("costs.npy")
+    blob = (np.memmap(os.path.join(path, "answers.bin"), dtype=np.uint8, mode="r")
+            if offsets[-1] > 0 else b"")
+
+    # Expired entries are dropped here; newest first so a full cache keeps
+    # the most recently used ones.
+    live = np.flatnonzero(timestamps + cache.ttl > time.time())[::-1]
+    generation = cache.begin_restore(matrix, slots[live], scales, full, sigs)
+
+    def fill():
+        # Everything but publishing the entries happens outside cache.lock,
+        # which lookups on the event loop wait for.
+        for start in range(0, len(live), RESTORE_CHUNK):
+            chunk = live[start:start + RESTORE_CHUNK]
+            chunk_slots = slots[chunk].tolist()
+            entries = [
+                SnapshotEntry(blob, begin, end, slot, timestamp, cost)
+                for begin, end, slot, timestamp, cost in zip(
+                    offsets[chunk].tolist(), offsets[chunk + 1].tolist(), chunk_slots,
+                    timestamps[chunk].tolist(), costs[chunk].tolist())
+            ]
+            bands = cache.prefilter.bands_of(chunk_slots) if cache.prefilter else None
+            if not cache.restore(generation, [k.decode() for k in keys[chunk]], entries, bands):
+                return
+
+    thread = threading.Thread(target=fill, daemon=True)
+    thread.start()
+    return thread
+
+def wipe(path):
+    with _save_lock:
+        shutil.rmtree(path, ignore_errors=True)
+
+async def run_periodic(cache, path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(save, cache, path)
+        except Exception as e:
+            print(f"Snapshot error: {e}")
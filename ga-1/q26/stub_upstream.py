@@ -0,0 +1,124 @@
+"""Offline stand-in for the OpenAI-compatible upstream (chat + embeddings).
+
+Usage: python stub_upstream.py [--port 8100] [--chat-latency-ms 400]
+
+Point the service at it with AIPIPE_BASE_URL=http://127.0.0.1:8100/v1
+(any AIPIPE_TOKEN works). bench_load.py starts it for you.
+
+Chat completions sleep for a configurable latency (streamed ones spread it
+over the chunks) and answer deterministically. Embeddings come from
+fake_embedding(): a bag of per-word random vectors with filler words
+down-weighted, so paraphrases that keep the content words land close
+together and unrelated queries do not.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+FILLER = {
+    "a", "an", "the", "how", "do", "does", "i", "can", "what", "is", "are", "to", "in",
+    "of", "for", "my", "me", "please", "way", "best", "explain", "tell", "about", "with",
+}
+FILLER_WEIGHT = 0.15
+_WORD = re.compile(r"[a-z0-9]+")
+
+def _word_vector(word, dim):
+    seed = int.from_bytes(hashlib.md5(word.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim)
+
+def fake_embedding(text, dim=256):
+    """Deterministic unit vector for text."""
+    vec = np.zeros(dim)
+    for word in _WORD.findall(text.lower()):
+        vec += _word_vector(word, dim) * (FILLER_WEIGHT if word in FILLER else 1.0)
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        return _word_vector(text, dim) / np.sqrt(dim)
+    return vec / norm
+
+def create_app(chat_latency_ms=400, embed_latency_ms=40, jitter=0.2, dim=256, chunks=20):
+    app = FastAPI()
+    app.state.requests = {"chat": 0, "embeddings": 0}
+
+    def delay(ms):
+        return max(0.0, ms * random.uniform(1 - jitter, 1 + jitter)) / 1000
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        app.state.requests["chat"] += 1
+        prompt = body["messages"][-1]["content"]
+        answer = f"Stub answer to: {prompt}. " + "lorem ipsum " * 40
+        created = int(time.time())
+        if not body.get("stream"):
+            await asyncio.sleep(delay(chat_latency_ms))
+            return {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                          "total_tokens": (len(prompt) + len(answer)) // 4},
+            }
+
+        async def events():
+            step = -(-len(answer) // chunks)
+            for i in range(0, len(answer), step):
+                await asyncio.sleep(delay(chat_latency_ms / chunks))
+                chunk = {
+                    "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": answer[i:i + step]},
+                                 "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        app.state.requests["embeddings"] += 1
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(delay(embed_latency_ms))
+        data = []
+        for i, text in enumerate(texts):
+            vec = fake_embedding(text, dim).astype(np.float32)
+            # The openai client asks for base64 unless told otherwise
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vec.tobytes()).decode()
+            else:
+                embedding = vec.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(t) // 4 for t in texts)
+        return {"object": "list", "data": data, "model": body["model"],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    @app.get("/stats")
+    def stats():
+        return app.state.requests
+
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--chat-latency-ms", type=float, default=400)
+    parser.add_argument("--embed-latency-ms", type=float, default=40)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--dim", type=int, default=256)
+    args = parser.parse_args()
+
+    app = create_app(args.chat_latency_ms, args.embed_latency_ms, args.jitter, args.dim)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,82 @@
+"""Snapshot round trip: save a full partition, load it into a fresh cache
+and check every entry comes back, including while new answers are being
+cached during the background restore.
+
+Run with `python -m pytest test_snapshot.py` or `python test_snapshot.py`.
+"""
+import tempfile
+
+import numpy as np
+
+import snapshot
+from cache import PartitionedCache
+
+PARTITION = "snapshot test"
+CAPACITY = 3000
+DIM = 32
+
+def vector(i):
+    return np.random.default_rng(i).standard_normal(DIM)
+
+def make_cache():
+    return PartitionedCache(settings={PARTITION: {"max_size": CAPACITY}})
+
+def saved_snapshot(path):
+    cache = make_cache()
+    part = cache.partition(PARTITION)
+    for i in range(CAPACITY):
+        part.set_with_embedding(f"query {i}", f"answer {i}", vector(i))
+    assert snapshot.save(cache, path) == CAPACITY
+
+def check_slots(part):
+    # Every slot is either held by exactly one entry or free
+    slots = [entry.slot for entry in part.store.values()]
+    assert len(set(slots)) == len(slots)
+    assert sorted(slots + part._free) == list(range(part.max_size))
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as path:
+        saved_snapshot(path)
+        cache = make_cache()
+        for thread in snapshot.load(cache, path):
+            thread.join()
+        part = cache.partition(PARTITION)
+        assert len(part.store) == CAPACITY
+        # Recency survives the round trip: the oldest entry goes first
+        assert list(part.policy.order) == list(part.store)
+        assert part.policy.victim() == part._hash("query 0")
+        for i in (0, CAPACITY // 2, CAPACITY - 1):
+            assert part.get_exact(f"query {i}") == f"answer {i}"
+            assert part.get_semantic(vector(i)) == f"answer {i}"
+            assert part.may_match(part.sketch(f"query {i}"))
+        assert part.prefilter.unsketched == 0
+        check_slots(part)
+
+def test_insert_during_restore():
+    chunk, snapshot.RESTORE_CHUNK = snapshot.RESTORE_CHUNK, 50
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            saved_snapshot(path)
+            cache = make_cache()
+            threads = snapshot.load(cache, path)
+            part = cache.partition(PARTITION)
+            # The snapshot reserves every slot: these must not fail while
+            # its entries are still being restored
+            for i in range(500):
+                part.set_with_embedding(f"new {i}", f"new answer {i}", vector(CAPACITY + i))
+            for thread in threads:
+                thread.join()
+            assert len(part.store) == CAPACITY
+            for i in range(500):
+                assert part.get_exact(f"new {i}") == f"new answer {i}"
+            # Room was made from the oldest snapshot entries
+            assert part.get_exact(f"query {CAPACITY - 1}") == f"answer {CAPACITY - 1}"
+            assert part.get_semantic(vector(CAPACITY - 1)) == f"answer {CAPACITY - 1}"
+            check_slots(part)
+    finally:
+        snapshot.RESTORE_CHUNK = chunk
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_insert_during_restore()
+    print("ok")